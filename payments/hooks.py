@@ -108,6 +108,44 @@ override_doctype_class = {"Web Form": "payments.overrides.payment_webform.Paymen
 # 	}
 # }
 
+doc_events = {
+	"Subscription Plan": {
+		"on_update": "payments.payment_gateways.stripe_integration.clear_plan_price_cache",
+		"on_trash": "payments.payment_gateways.stripe_integration.clear_plan_price_cache",
+	}
+}
+
+# Payment Gateways
+# ----------------
+# Settings doctypes that back a payment gateway. Doctypes with a `prefix` hold one record
+# per merchant account, each exposed as a Payment Gateway named `prefix + record name`.
+# `sdk` lists the modules the gateway imports lazily, see payments.utils.sdk
+
+payment_gateways = [
+	{"gateway": "Razorpay", "settings": "Razorpay Settings", "sdk": ["razorpay"]},
+	{"gateway": "PayPal", "settings": "PayPal Settings"},
+	{"gateway": "Paytm", "settings": "Paytm Settings", "sdk": ["paytmchecksum"]},
+	{"prefix": "Stripe-", "settings": "Stripe Settings", "sdk": ["stripe"]},
+	{"prefix": "Braintree-", "settings": "Braintree Settings", "sdk": ["braintree"]},
+	{"prefix": "GoCardless-", "settings": "GoCardless Settings", "sdk": ["gocardless_pro"]},
+	{"prefix": "Mpesa-", "settings": "Mpesa Settings"},
+]
+
+# Request Events
+# ----------------
+
+# open pooled gateway connections and import the SDKs of enabled gateways when a worker
+# starts serving a site (opt-in through `payments_prewarm_hosts` and `payments_preload_sdks`
+# in site config)
+before_request = [
+	"payments.utils.transport.prewarm_connections",
+	"payments.utils.sdk.preload_gateway_sdks",
+]
+before_job = [
+	"payments.utils.transport.prewarm_connections",
+	"payments.utils.sdk.preload_gateway_sdks",
+]
+
 # Scheduled Tasks
 # ---------------
 
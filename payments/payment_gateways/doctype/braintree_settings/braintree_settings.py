@@ -1,16 +1,36 @@
 # Copyright (c) 2018, Frappe Technologies and contributors
 # License: MIT. See LICENSE
 
+import json
+import time
 from urllib.parse import urlencode
 
-import braintree
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, get_url
 
-from payments.utils import create_payment_gateway
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_cached_password,
+	get_payment_gateway_name,
+	integration_request_update,
+)
+from payments.utils.async_client import fan_out
+from payments.utils.transport import get_timeout
+from payments.utils.utils import (
+	get_generation_cached,
+	get_payment_gateway_cache_generation,
+)
+
+# BraintreeGateway per Braintree Settings name
+_gateways = {}
+
+# pre-generated client tokens kept per account, see get_gateway_client_token
+CLIENT_TOKEN_POOL_SIZE = 10
+CLIENT_TOKEN_TTL = 10 * 60
 
 
 class BraintreeSettings(Document):
@@ -154,27 +174,32 @@ class BraintreeSettings(Document):
 
 	def validate(self):
 		if not self.flags.ignore_mandatory:
-			self.configure_braintree()
+			self.make_braintree_gateway()
 
 	def on_update(self):
-		create_payment_gateway(
-			"Braintree-" + self.gateway_name,
-			settings="Braintree Settings",
-			controller=self.gateway_name,
-		)
-		call_hook_method("payment_gateway_enabled", gateway="Braintree-" + self.gateway_name)
+		gateway = get_payment_gateway_name(self.doctype, self.gateway_name)
+		create_payment_gateway(gateway, settings=self.doctype, controller=self.gateway_name)
+		call_hook_method("payment_gateway_enabled", gateway=gateway)
+		clear_payment_gateway_cache()
+
+	def make_braintree_gateway(self):
+		"""Return a `braintree.BraintreeGateway` for this account, without touching the global
+		`braintree.Configuration`"""
+		import braintree
 
-	def configure_braintree(self):
 		if self.use_sandbox:
 			environment = "sandbox"
 		else:
 			environment = "production"
 
-		braintree.Configuration.configure(
-			environment=environment,
-			merchant_id=self.merchant_id,
-			public_key=self.public_key,
-			private_key=self.get_password(fieldname="private_key", raise_exception=False),
+		return braintree.BraintreeGateway(
+			braintree.Configuration(
+				environment=environment,
+				merchant_id=self.merchant_id,
+				public_key=self.public_key,
+				private_key=get_cached_password(self, "private_key", raise_exception=False),
+				timeout=get_timeout()[1],
+			)
 		)
 
 	def validate_transaction_currency(self, currency):
@@ -208,12 +233,10 @@ class BraintreeSettings(Document):
 			}
 
 	def create_charge_on_braintree(self):
-		self.configure_braintree()
-
 		redirect_to = self.data.get("redirect_to") or None
 		redirect_message = self.data.get("redirect_message") or None
 
-		result = braintree.Transaction.sale(
+		result = get_braintree_gateway(self.name).transaction.sale(
 			{
 				"amount": self.data.amount,
 				"payment_method_nonce": self.data.payload_nonce,
@@ -221,29 +244,32 @@ class BraintreeSettings(Document):
 			}
 		)
 
-		if result.is_success:
-			self.integration_request.db_set("status", "Completed", update_modified=False)
-			self.flags.status_changed_to = "Completed"
-			self.integration_request.db_set("output", result.transaction.status, update_modified=False)
-
-		elif result.transaction:
-			self.integration_request.db_set("status", "Failed", update_modified=False)
-			error_log = frappe.log_error(
-				"code: "
-				+ str(result.transaction.processor_response_code)
-				+ " | text: "
-				+ str(result.transaction.processor_response_text),
-				"Braintree Payment Error",
-			)
-			self.integration_request.db_set("error", error_log.error, update_modified=False)
-		else:
-			self.integration_request.db_set("status", "Failed", update_modified=False)
-			for error in result.errors.deep_errors:
+		with integration_request_update(self.integration_request) as changes:
+			if result.is_success:
+				changes.status = "Completed"
+				self.flags.status_changed_to = "Completed"
+				changes.output = result.transaction.status
+
+			elif result.transaction:
+				changes.status = "Failed"
 				error_log = frappe.log_error(
-					"code: " + str(error.code) + " | message: " + str(error.message),
+					"code: "
+					+ str(result.transaction.processor_response_code)
+					+ " | text: "
+					+ str(result.transaction.processor_response_text),
 					"Braintree Payment Error",
 				)
-				self.integration_request.db_set("error", error_log.error, update_modified=False)
+				changes.error = error_log.error
+			else:
+				changes.status = "Failed"
+				errors = []
+				for error in result.errors.deep_errors:
+					error_log = frappe.log_error(
+						"code: " + str(error.code) + " | message: " + str(error.message),
+						"Braintree Payment Error",
+					)
+					errors.append(error_log.error)
+				changes.error = "\n".join(errors)
 
 		if self.flags.status_changed_to == "Completed":
 			status = "Completed"
@@ -276,16 +302,73 @@ class BraintreeSettings(Document):
 
 
 def get_gateway_controller(doc):
-	payment_request = frappe.get_doc("Payment Request", doc)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", payment_request.payment_gateway, "gateway_controller"
-	)
+	payment_gateway = frappe.db.get_value("Payment Request", doc, "payment_gateway")
+	gateway_controller = frappe.db.get_value("Payment Gateway", payment_gateway, "gateway_controller")
 	return gateway_controller
 
 
+def get_braintree_gateway(gateway_name):
+	"""Return the `BraintreeGateway` of a Braintree Settings record, built once per worker and
+	rebuilt after any Braintree Settings or Payment Gateway is saved"""
+	return get_generation_cached(
+		_gateways,
+		gateway_name,
+		lambda: frappe.get_doc("Braintree Settings", gateway_name).make_braintree_gateway(),
+	)
+
+
 def get_client_token(doc):
-	gateway_controller = get_gateway_controller(doc)
-	settings = frappe.get_doc("Braintree Settings", gateway_controller)
-	settings.configure_braintree()
+	return get_gateway_client_token(get_gateway_controller(doc))
+
+
+def get_gateway_client_token(gateway_name):
+	"""Return a client token for the drop-in, taken from the pool of pre-generated tokens when
+	one is available
+
+	Tokens older than `CLIENT_TOKEN_TTL` are discarded. The pool is topped up by a background
+	job once it is half empty."""
+	key = get_client_token_pool_key(gateway_name)
+	cache = frappe.cache()
+
+	token = None
+	while not token:
+		entry = cache.rpop(key)
+		if not entry:
+			break
+
+		entry = json.loads(entry)
+		if entry["created"] + CLIENT_TOKEN_TTL > time.time():
+			token = entry["token"]
+
+	if cache.llen(key) < CLIENT_TOKEN_POOL_SIZE // 2 and not cache.get_value(f"{key}_refill"):
+		cache.set_value(f"{key}_refill", 1, expires_in_sec=60)
+		frappe.enqueue(
+			"payments.payment_gateways.doctype.braintree_settings.braintree_settings.refill_client_token_pool",
+			queue="short",
+			gateway_name=gateway_name,
+		)
+
+	return token or get_braintree_gateway(gateway_name).client_token.generate()
+
+
+def refill_client_token_pool(gateway_name):
+	key = get_client_token_pool_key(gateway_name)
+	cache = frappe.cache()
+	gateway = get_braintree_gateway(gateway_name)
+
+	missing = CLIENT_TOKEN_POOL_SIZE - cache.llen(key)
+	for result in fan_out(lambda i: gateway.client_token.generate(), range(missing)):
+		if result.error:
+			frappe.log_error(result.traceback, "Braintree Client Token Error")
+			continue
+
+		cache.lpush(key, json.dumps({"token": result.result, "created": time.time()}))
+
+	cache.ltrim(key, 0, CLIENT_TOKEN_POOL_SIZE - 1)
+	# pools of replaced credentials are keyed by an old generation and are never read again
+	cache.expire(cache.make_key(key), CLIENT_TOKEN_TTL)
+	cache.delete_value(f"{key}_refill")
+
 
-	return braintree.ClientToken.generate()
+def get_client_token_pool_key(gateway_name):
+	return f"braintree_client_tokens:{gateway_name}:{get_payment_gateway_cache_generation()}"
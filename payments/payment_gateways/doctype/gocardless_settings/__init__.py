@@ -7,61 +7,95 @@ import hmac
 import json
 
 import frappe
+from frappe.query_builder import Case
+from frappe.utils import now
+
+from payments.utils import insert_webhook_request, integration_request_update
 
 
 @frappe.whitelist(allow_guest=True)
-def webhooks():
+def webhooks(account=None):
+	"""Store a verified webhook and process its events in the background
+
+	`account` is the GoCardless Settings the endpoint was registered for, its secret is the
+	only one checked. A webhook is redelivered with the same `meta.webhook_id` until it is
+	acknowledged, redeliveries are dropped here."""
 	r = frappe.request
 	if not r:
 		return
 
-	if not authenticate_signature(r):
+	if not authenticate_signature(r, account):
 		raise frappe.AuthenticationError
 
-	gocardless_events = json.loads(r.get_data()) or []
-	for event in gocardless_events["events"]:
-		set_status(event)
+	webhook_id = (json.loads(r.get_data()).get("meta") or {}).get("webhook_id")
+	doc = insert_webhook_request("GoCardless", webhook_id, r.get_data(as_text=True), "Webhook")
+	if not doc:
+		return 200
+
+	frappe.enqueue(
+		"payments.payment_gateways.doctype.gocardless_settings.process_webhook",
+		queue="short",
+		integration_request=doc.name,
+	)
 
 	return 200
 
 
-def set_status(event):
-	resource_type = event.get("resource_type", {})
+def process_webhook(integration_request):
+	integration_request = frappe.get_doc("Integration Request", integration_request)
+	events = json.loads(integration_request.data).get("events") or []
+
+	with integration_request_update(integration_request) as changes:
+		set_mandate_statuses(events)
+		changes.status = "Completed"
+
+
+def set_mandate_statuses(events):
+	"""Apply the last state of every mandate in `events` with one UPDATE"""
+	# the same event can appear more than once, keep one per id in the order they happened
+	events = sorted({event["id"]: event for event in events}.values(), key=lambda e: e["created_at"])
+
+	disabled = {}
+	for event in events:
+		if event.get("resource_type") == "mandates":
+			for mandate in get_mandates(event):
+				disabled[mandate] = 0 if is_mandate_active(event["action"]) else 1
+
+	if not disabled:
+		return
+
+	Mandate = frappe.qb.DocType("GoCardless Mandate")
+	case = Case()
+	for mandate, value in disabled.items():
+		case = case.when(Mandate.name == mandate, value)
 
-	if resource_type == "mandates":
-		set_mandate_status(event)
+	frappe.qb.update(Mandate).set(Mandate.disabled, case).set(Mandate.modified, now()).where(
+		Mandate.name.isin(list(disabled))
+	).run()
 
 
-def set_mandate_status(event):
-	mandates = []
+def get_mandates(event):
 	if isinstance(event["links"], (list,)):
-		for link in event["links"]:
-			mandates.append(link["mandate"])
-	else:
-		mandates.append(event["links"]["mandate"])
-
-	if (
-		event["action"] == "pending_customer_approval"
-		or event["action"] == "pending_submission"
-		or event["action"] == "submitted"
-		or event["action"] == "active"
-	):
-		disabled = 0
-	else:
-		disabled = 1
-
-	for mandate in mandates:
-		frappe.db.set_value("GoCardless Mandate", mandate, "disabled", disabled)
-
-
-def authenticate_signature(r):
-	"""Returns True if the received signature matches the generated signature"""
+		return [link["mandate"] for link in event["links"]]
+
+	return [event["links"]["mandate"]]
+
+
+def is_mandate_active(action):
+	return action in ("pending_customer_approval", "pending_submission", "submitted", "active")
+
+
+def authenticate_signature(r, account=None):
+	"""Returns True if the received signature matches the generated signature
+
+	Endpoints registered without `account` are checked against the secret of every account."""
 	received_signature = frappe.get_request_header("Webhook-Signature")
 
 	if not received_signature:
 		return False
 
-	for key in get_webhook_keys():
+	keys = [get_webhook_key(account)] if account else get_webhook_keys()
+	for key in filter(None, keys):
 		computed_signature = hmac.new(key.encode("utf-8"), r.get_data(), hashlib.sha256).hexdigest()
 		if hmac.compare_digest(str(received_signature), computed_signature):
 			return True
@@ -85,5 +119,17 @@ def get_webhook_keys():
 	return frappe.cache().get_value("gocardless_webhooks_secret", _get_webhook_keys)
 
 
+def get_webhook_key(account):
+	# `account` comes from the url, only the secrets of existing accounts are cached
+	key = frappe.cache().hget("gocardless_webhook_key", account)
+	if not key:
+		key = frappe.db.get_value("GoCardless Settings", account, "webhooks_secret")
+		if key:
+			frappe.cache().hset("gocardless_webhook_key", account, key)
+
+	return key
+
+
 def clear_cache():
 	frappe.cache().delete_value("gocardless_webhooks_secret")
+	frappe.cache().delete_value("gocardless_webhook_key")
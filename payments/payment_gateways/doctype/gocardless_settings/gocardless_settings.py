@@ -5,12 +5,14 @@
 from urllib.parse import urlencode
 
 import frappe
-import gocardless_pro
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, flt, get_url
 
+from payments.payment_gateways.doctype.gocardless_settings import clear_cache
+from payments.utils import integration_request_update
+
 
 class GoCardlessSettings(Document):
 	supported_currencies = ["EUR", "DKK", "GBP", "SEK", "AUD", "NZD", "CAD", "USD"]
@@ -19,6 +21,8 @@ class GoCardlessSettings(Document):
 		self.initialize_client()
 
 	def initialize_client(self):
+		import gocardless_pro
+
 		self.environment = self.get_environment()
 		try:
 			self.client = gocardless_pro.Client(
@@ -29,12 +33,21 @@ class GoCardlessSettings(Document):
 			frappe.throw(e)
 
 	def on_update(self):
-		from payments.utils import create_payment_gateway
-
-		create_payment_gateway(
-			"GoCardless-" + self.gateway_name, settings="GoCardless Settings", controller=self.gateway_name
+		from payments.utils import (
+			clear_payment_gateway_cache,
+			create_payment_gateway,
+			get_payment_gateway_name,
 		)
-		call_hook_method("payment_gateway_enabled", gateway="GoCardless-" + self.gateway_name)
+
+		gateway = get_payment_gateway_name(self.doctype, self.gateway_name)
+		create_payment_gateway(gateway, settings=self.doctype, controller=self.gateway_name)
+		call_hook_method("payment_gateway_enabled", gateway=gateway)
+		clear_payment_gateway_cache()
+		# cleared once the new secret is visible, or a webhook in between caches the old one
+		frappe.db.after_commit.add(clear_cache)
+
+	def on_trash(self):
+		frappe.db.after_commit.add(clear_cache)
 
 	def on_payment_request_submission(self, data):
 		if data.reference_doctype != "Fees":
@@ -145,32 +158,33 @@ class GoCardlessSettings(Document):
 				},
 			)
 
-			if (
-				payment.status == "pending_submission"
-				or payment.status == "pending_customer_approval"
-				or payment.status == "submitted"
-			):
-				self.integration_request.db_set("status", "Authorized", update_modified=False)
-				self.flags.status_changed_to = "Completed"
-				self.integration_request.db_set("output", payment.status, update_modified=False)
-
-			elif payment.status == "confirmed" or payment.status == "paid_out":
-				self.integration_request.db_set("status", "Completed", update_modified=False)
-				self.flags.status_changed_to = "Completed"
-				self.integration_request.db_set("output", payment.status, update_modified=False)
-
-			elif (
-				payment.status == "cancelled"
-				or payment.status == "customer_approval_denied"
-				or payment.status == "charged_back"
-			):
-				self.integration_request.db_set("status", "Cancelled", update_modified=False)
-				frappe.log_error("Gocardless payment cancelled")
-				self.integration_request.db_set("error", payment.status, update_modified=False)
-			else:
-				self.integration_request.db_set("status", "Failed", update_modified=False)
-				frappe.log_error("Gocardless payment failed")
-				self.integration_request.db_set("error", payment.status, update_modified=False)
+			with integration_request_update(self.integration_request) as changes:
+				if (
+					payment.status == "pending_submission"
+					or payment.status == "pending_customer_approval"
+					or payment.status == "submitted"
+				):
+					changes.status = "Authorized"
+					self.flags.status_changed_to = "Completed"
+					changes.output = payment.status
+
+				elif payment.status == "confirmed" or payment.status == "paid_out":
+					changes.status = "Completed"
+					self.flags.status_changed_to = "Completed"
+					changes.output = payment.status
+
+				elif (
+					payment.status == "cancelled"
+					or payment.status == "customer_approval_denied"
+					or payment.status == "charged_back"
+				):
+					changes.status = "Cancelled"
+					frappe.log_error("Gocardless payment cancelled")
+					changes.error = payment.status
+				else:
+					changes.status = "Failed"
+					frappe.log_error("Gocardless payment failed")
+					changes.error = payment.status
 
 		except Exception as e:
 			frappe.log_error("GoCardless Payment Error")
@@ -1,8 +1,104 @@
 # Copyright (c) 2018, Frappe Technologies and Contributors
 # See license.txt
 
+import hashlib
+import hmac
 import unittest
+from unittest.mock import patch
+
+import frappe
+
+from payments.payment_gateways.doctype.gocardless_settings import (
+	authenticate_signature,
+	set_mandate_statuses,
+)
+
+MODULE = "payments.payment_gateways.doctype.gocardless_settings"
 
 
 class TestGoCardlessSettings(unittest.TestCase):
-	pass
+	def setUp(self):
+		for mandate in ("_Test MD1", "_Test MD2"):
+			create_mandate(mandate)
+
+	def tearDown(self):
+		frappe.db.delete("GoCardless Mandate", {"name": ("like", "_Test MD%")})
+
+	def test_last_event_of_a_mandate_wins(self):
+		# delivered out of order, the cancellation happened last
+		set_mandate_statuses(
+			[
+				make_event("EV2", "cancelled", "_Test MD1", "2024-06-01T10:00:01Z"),
+				make_event("EV1", "active", "_Test MD1", "2024-06-01T10:00:00Z"),
+				make_event("EV3", "active", "_Test MD2", "2024-06-01T10:00:00Z"),
+			]
+		)
+
+		self.assertEqual(frappe.db.get_value("GoCardless Mandate", "_Test MD1", "disabled"), 1)
+		self.assertEqual(frappe.db.get_value("GoCardless Mandate", "_Test MD2", "disabled"), 0)
+
+	def test_duplicate_events_are_applied_once(self):
+		frappe.db.set_value("GoCardless Mandate", "_Test MD1", "disabled", 1)
+		event = make_event("EV1", "active", "_Test MD1", "2024-06-01T10:00:00Z")
+
+		set_mandate_statuses([event, event])
+
+		self.assertEqual(frappe.db.get_value("GoCardless Mandate", "_Test MD1", "disabled"), 0)
+
+	def test_other_resources_are_ignored(self):
+		event = make_event("EV1", "cancelled", "_Test MD1", "2024-06-01T10:00:00Z")
+		event["resource_type"] = "payments"
+
+		set_mandate_statuses([event])
+
+		self.assertEqual(frappe.db.get_value("GoCardless Mandate", "_Test MD1", "disabled"), 0)
+
+
+class TestGoCardlessWebhookSignature(unittest.TestCase):
+	body = b'{"events": []}'
+
+	def authenticate(self, secret, account=None):
+		signature = hmac.new(secret.encode(), self.body, hashlib.sha256).hexdigest()
+		request = frappe._dict(get_data=lambda: self.body)
+
+		with (
+			patch("frappe.get_request_header", return_value=signature),
+			patch(f"{MODULE}.get_webhook_key", return_value="_Test Secret A"),
+			patch(f"{MODULE}.get_webhook_keys", return_value=["_Test Secret A", "_Test Secret B"]),
+		):
+			return authenticate_signature(request, account)
+
+	def test_signature_of_the_account(self):
+		self.assertTrue(self.authenticate("_Test Secret A", account="_Test Account A"))
+
+	def test_signature_of_another_account_is_rejected(self):
+		self.assertFalse(self.authenticate("_Test Secret B", account="_Test Account A"))
+
+	def test_any_account_without_account(self):
+		self.assertTrue(self.authenticate("_Test Secret B"))
+
+	def test_wrong_signature(self):
+		self.assertFalse(self.authenticate("_Test Wrong Secret"))
+
+
+def create_mandate(mandate):
+	if not frappe.db.exists("GoCardless Mandate", mandate):
+		frappe.get_doc(
+			{
+				"doctype": "GoCardless Mandate",
+				"mandate": mandate,
+				"gocardless_customer": "_Test CU1",
+			}
+		).insert(ignore_permissions=True)
+
+	frappe.db.set_value("GoCardless Mandate", mandate, "disabled", 0)
+
+
+def make_event(id, action, mandate, created_at):
+	return {
+		"id": id,
+		"created_at": created_at,
+		"resource_type": "mandates",
+		"action": action,
+		"links": {"mandate": mandate},
+	}
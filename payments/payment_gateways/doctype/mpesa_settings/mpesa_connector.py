@@ -1,9 +1,10 @@
 import base64
 import datetime
 
-import requests
 from requests.auth import HTTPBasicAuth
 
+from payments.utils import transport
+
 
 class MpesaConnector:
 	def __init__(
@@ -33,7 +34,9 @@ class MpesaConnector:
 		"""
 		authenticate_uri = "/oauth/v1/generate?grant_type=client_credentials"
 		authenticate_url = f"{self.base_url}{authenticate_uri}"
-		r = requests.get(authenticate_url, auth=HTTPBasicAuth(self.app_key, self.app_secret))
+		r = transport.request(
+			"GET", authenticate_url, auth=HTTPBasicAuth(self.app_key, self.app_secret)
+		)
 		self.authentication_token = r.json()["access_token"]
 		return r.json()["access_token"]
 
@@ -81,7 +84,7 @@ class MpesaConnector:
 			"Content-Type": "application/json",
 		}
 		saf_url = "{}{}".format(self.base_url, "/mpesa/accountbalance/v1/query")
-		r = requests.post(saf_url, headers=headers, json=payload)
+		r = transport.request("POST", saf_url, headers=headers, json=payload)
 		return r.json()
 
 	def stk_push(
@@ -145,5 +148,5 @@ class MpesaConnector:
 		}
 
 		saf_url = "{}{}".format(self.base_url, "/mpesa/stkpush/v1/processrequest")
-		r = requests.post(saf_url, headers=headers, json=payload)
+		r = transport.request("POST", saf_url, headers=headers, json=payload)
 		return r.json()
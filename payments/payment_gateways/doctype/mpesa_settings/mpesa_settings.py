@@ -14,7 +14,12 @@ from payments.payment_gateways.doctype.mpesa_settings.mpesa_connector import Mpe
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_custom_fields import (
 	create_custom_pos_fields,
 )
-from payments.utils import erpnext_app_import_guard
+from payments.utils import (
+	erpnext_app_import_guard,
+	get_cached_password,
+	get_payment_gateway_registry,
+)
+from payments.utils.async_client import fan_out
 
 
 class MpesaSettings(Document):
@@ -29,40 +34,54 @@ class MpesaSettings(Document):
 			)
 
 	def on_update(self):
-		from payments.utils import create_payment_gateway
+		from payments.utils import (
+			clear_payment_gateway_cache,
+			create_payment_gateway,
+			get_payment_gateway_name,
+		)
 
 		if "erpnext" in frappe.get_installed_apps():
 			create_custom_pos_fields()
 
-		create_payment_gateway(
-			"Mpesa-" + self.payment_gateway_name,
-			settings="Mpesa Settings",
-			controller=self.payment_gateway_name,
-		)
-		call_hook_method(
-			"payment_gateway_enabled", gateway="Mpesa-" + self.payment_gateway_name, payment_channel="Phone"
-		)
+		gateway = get_payment_gateway_name(self.doctype, self.payment_gateway_name)
+		create_payment_gateway(gateway, settings=self.doctype, controller=self.payment_gateway_name)
+		call_hook_method("payment_gateway_enabled", gateway=gateway, payment_channel="Phone")
+		clear_payment_gateway_cache()
 
 		# required to fetch the bank account details from the payment gateway account
 		frappe.db.commit()  # nosemgrep
-		create_mode_of_payment("Mpesa-" + self.payment_gateway_name, payment_type="Phone")
+		create_mode_of_payment(gateway, payment_type="Phone")
 
 	def request_for_payment(self, **kwargs):
 		args = frappe._dict(kwargs)
 		request_amounts = self.split_request_amount_according_to_transaction_limit(args)
 
-		for i, amount in enumerate(request_amounts):
-			args.request_amount = amount
-			if frappe.flags.in_test:
-				from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
-					get_payment_request_response_payload,
-				)
+		if frappe.flags.in_test:
+			from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
+				get_payment_request_response_payload,
+			)
+
+			responses = [get_payment_request_response_payload(amount) for amount in request_amounts]
+		else:
+			# the split requests are independent, send them concurrently
+			responses = generate_stk_pushes(args, request_amounts)
+
+		# record every push before raising, a push that went out can still be paid
+		errors = []
+		for amount, response in zip(request_amounts, responses):
+			if response is None:
+				errors.append(None)
+				continue
 
-				response = frappe._dict(get_payment_request_response_payload(amount))
-			else:
-				response = frappe._dict(generate_stk_push(**args))
+			args.request_amount = amount
+			error = self.record_api_response("CheckoutRequestID", args, frappe._dict(response))
+			if error:
+				errors.append(error)
 
-			self.handle_api_response("CheckoutRequestID", args, response)
+		if None in errors:
+			throw_stk_push_error()
+		elif errors:
+			frappe.throw(_(getattr(errors[0], "errorMessage")), title=_("Transaction Error"))
 
 	def split_request_amount_according_to_transaction_limit(self, args):
 		request_amount = args.request_amount
@@ -103,6 +122,12 @@ class MpesaSettings(Document):
 
 	def handle_api_response(self, global_id, request_dict, response):
 		"""Response received from API calls returns a global identifier for each transaction, this code is returned during the callback."""
+		error = self.record_api_response(global_id, request_dict, response)
+		if error:
+			frappe.throw(_(getattr(error, "errorMessage")), title=_("Transaction Error"))
+
+	def record_api_response(self, global_id, request_dict, response):
+		"""Log the response as an Integration Request, returns the response if it is an error"""
 		# check error response
 		if getattr(response, "requestId"):
 			req_name = getattr(response, "requestId")
@@ -115,20 +140,35 @@ class MpesaSettings(Document):
 		if not frappe.db.exists("Integration Request", req_name):
 			create_request_log(request_dict, "Host", "Mpesa", req_name, error)
 
-		if error:
-			frappe.throw(_(getattr(response, "errorMessage")), title=_("Transaction Error"))
+		return error
 
 
 def generate_stk_push(**kwargs):
 	"""Generate stk push by making a API call to the stk push API."""
 	args = frappe._dict(kwargs)
+	response = generate_stk_pushes(args, [args.request_amount])[0]
+	if response is None:
+		throw_stk_push_error()
+
+	return response
+
+
+def generate_stk_pushes(args, request_amounts):
+	"""Make one stk push per requested amount, concurrently, and return the responses in order.
+
+	Pushes that could not be sent are logged and returned as None, so that the caller can
+	still record every push that went out before raising."""
 	try:
 		callback_url = (
 			get_request_site_address(True)
 			+ "/api/method/payments.payment_gateways.doctype.mpesa_settings.mpesa_settings.verify_transaction"
 		)
 
-		mpesa_settings = frappe.get_doc("Mpesa Settings", args.payment_gateway[6:])
+		gateway = get_payment_gateway_registry().get(args.payment_gateway)
+		if not gateway:
+			frappe.throw(_("{0} Settings not found").format(args.payment_gateway))
+
+		mpesa_settings = frappe.get_doc(gateway.settings, gateway.docname)
 		env = "production" if not mpesa_settings.sandbox else "sandbox"
 		# for sandbox, business shortcode is same as till number
 		business_shortcode = (
@@ -138,29 +178,42 @@ def generate_stk_push(**kwargs):
 		connector = MpesaConnector(
 			env=env,
 			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
+			app_secret=get_cached_password(mpesa_settings, "consumer_secret"),
 		)
 
 		mobile_number = sanitize_mobile_number(args.sender)
+		passcode = get_cached_password(mpesa_settings, "online_passkey")
+
+	except Exception:
+		frappe.log_error("Mpesa Express Transaction Error")
+		throw_stk_push_error()
 
-		response = connector.stk_push(
+	def stk_push(amount):
+		return connector.stk_push(
 			business_shortcode=business_shortcode,
-			amount=args.request_amount,
-			passcode=mpesa_settings.get_password("online_passkey"),
+			amount=amount,
+			passcode=passcode,
 			callback_url=callback_url,
 			reference_code=mpesa_settings.till_number,
 			phone_number=mobile_number,
 			description="POS Payment",
 		)
 
-		return response
+	responses = []
+	for result in fan_out(stk_push, request_amounts):
+		if result.error:
+			frappe.log_error("Mpesa Express Transaction Error", result.traceback)
 
-	except Exception:
-		frappe.log_error("Mpesa Express Transaction Error")
-		frappe.throw(
-			_("Issue detected with Mpesa configuration, check the error logs for more details"),
-			title=_("Mpesa Express Error"),
-		)
+		responses.append(result.result)
+
+	return responses
+
+
+def throw_stk_push_error():
+	frappe.throw(
+		_("Issue detected with Mpesa configuration, check the error logs for more details"),
+		title=_("Mpesa Express Error"),
+	)
 
 
 def sanitize_mobile_number(number):
@@ -260,7 +313,7 @@ def get_account_balance(request_payload):
 		connector = MpesaConnector(
 			env=env,
 			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
+			app_secret=get_cached_password(mpesa_settings, "consumer_secret"),
 		)
 
 		callback_url = (
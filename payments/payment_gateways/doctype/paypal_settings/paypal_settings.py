@@ -57,26 +57,53 @@ payment_status - payment gateway will put payment status on callback.
 For paypal payment status parameter is one from: [Completed, Cancelled, Failed]
 
 
+### 4. REST API
+
+Set API to REST and fill in the Client ID and Client Secret of a PayPal REST app to take one
+time payments through the Orders v2 API: one call creates the order, one call captures it
+when the buyer returns. The OAuth access token is cached until it expires. Subscriptions
+keep using the classic API.
+
 More Details:
 <div class="small">For details on how to get your API credentials, follow this link: <a href="https://developer.paypal.com/docs/classic/api/apiCredentials/" target="_blank">https://developer.paypal.com/docs/classic/api/apiCredentials/</a></div>
 
 """
 
+import hashlib
 import json
+from functools import partial
 from urllib.parse import urlencode
 
 import frappe
 import pytz
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_post_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, get_datetime, get_url
+from frappe.utils import call_hook_method, cint, flt, get_datetime, get_url
 from frappe.utils.data import get_system_timezone
 
-from payments.utils import create_payment_gateway
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_cached_password,
+	get_integration_request_by_reference,
+	insert_webhook_request,
+	set_payment_gateway_reference,
+)
+from payments.utils.bulk import run_bulk_requests
+from payments.utils.transport import fetch, make_post_request, make_request
 
 api_path = "/api/method/payments.payment_gateways.doctype.paypal_settings.paypal_settings"
 
+# refresh the OAuth token this many seconds before PayPal expires it
+TOKEN_EXPIRY_MARGIN = 60
+
+# requests per second for bulk jobs
+RATE_LIMIT = 10
+
+# PayPal rejects amounts with decimals in these currencies
+ZERO_DECIMAL_CURRENCIES = ("HUF", "JPY", "TWD")
+
 
 class PayPalSettings(Document):
 	supported_currencies = [
@@ -121,7 +148,7 @@ class PayPalSettings(Document):
 			self.validate_paypal_credentails()
 
 	def on_update(self):
-		pass
+		clear_payment_gateway_cache()
 
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
@@ -134,7 +161,7 @@ class PayPalSettings(Document):
 	def get_paypal_params_and_url(self):
 		params = {
 			"USER": self.api_username,
-			"PWD": self.get_password(fieldname="api_password", raise_exception=False),
+			"PWD": get_cached_password(self, "api_password", raise_exception=False),
 			"SIGNATURE": self.signature,
 			"VERSION": "98",
 			"METHOD": "GetPalDetails",
@@ -158,6 +185,15 @@ class PayPalSettings(Document):
 		return params, api_url
 
 	def validate_paypal_credentails(self):
+		if self.use_rest_api():
+			try:
+				self.get_access_token()
+			except Exception:
+				frappe.throw(_("Invalid payment gateway credentials"))
+
+		if self.api_type == "REST" and not self.api_username:
+			return
+
 		params, url = self.get_paypal_params_and_url()
 		params = urlencode(params)
 
@@ -173,6 +209,9 @@ class PayPalSettings(Document):
 	def get_payment_url(self, **kwargs):
 		setattr(self, "use_sandbox", cint(kwargs.get("use_sandbox", 0)))
 
+		if self.use_rest_api() and not kwargs.get("subscription_details"):
+			return self.create_order(**kwargs)
+
 		response = self.execute_set_express_checkout(**kwargs)
 
 		if self.paypal_sandbox or self.use_sandbox:
@@ -216,6 +255,95 @@ class PayPalSettings(Document):
 
 		return response
 
+	def use_rest_api(self):
+		return self.api_type == "REST"
+
+	def get_rest_credentials(self):
+		if self.use_sandbox:
+			return frappe.conf.sandbox_client_id, frappe.conf.sandbox_client_secret
+
+		return self.client_id, get_cached_password(self, "client_secret", raise_exception=False)
+
+	def get_rest_api_url(self):
+		if self.paypal_sandbox or self.use_sandbox:
+			return "https://api-m.sandbox.paypal.com"
+
+		return "https://api-m.paypal.com"
+
+	def get_access_token(self):
+		"""Return an OAuth access token, cached until shortly before it expires"""
+		client_id, client_secret = self.get_rest_credentials()
+		key = "paypal_access_token:" + hashlib.sha256(
+			f"{self.get_rest_api_url()}:{client_id}:{client_secret}".encode()
+		).hexdigest()
+
+		access_token = frappe.cache().get_value(key)
+		if access_token:
+			return access_token
+
+		response = make_request(
+			"POST",
+			f"{self.get_rest_api_url()}/v1/oauth2/token",
+			auth=(client_id, client_secret),
+			data={"grant_type": "client_credentials"},
+		)
+
+		access_token = response["access_token"]
+		expires_in = cint(response.get("expires_in")) - TOKEN_EXPIRY_MARGIN
+		if expires_in > 0:
+			frappe.cache().set_value(key, access_token, expires_in_sec=expires_in)
+
+		return access_token
+
+	def make_rest_request(self, method, path, json=None, request_id=None):
+		headers = {"Authorization": f"Bearer {self.get_access_token()}"}
+		if request_id:
+			# makes retries of the same call idempotent on PayPal's side
+			headers["PayPal-Request-Id"] = request_id
+
+		return make_request(method, f"{self.get_rest_api_url()}{path}", headers=headers, json=json)
+
+	def create_order(self, **kwargs):
+		"""Create an Orders v2 order and return the approval URL for the buyer"""
+		order = self.make_rest_request(
+			"POST",
+			"/v2/checkout/orders",
+			json={
+				"intent": "CAPTURE",
+				"purchase_units": [
+					{
+						"reference_id": kwargs.get("order_id") or kwargs.get("reference_docname"),
+						"description": kwargs.get("description"),
+						"amount": {
+							"currency_code": kwargs["currency"].upper(),
+							"value": format_amount(kwargs["amount"], kwargs["currency"]),
+						},
+					}
+				],
+				"application_context": {
+					# PayPal appends ?token=<order id> to both
+					"return_url": get_url(f"{api_path}.confirm_payment"),
+					"cancel_url": get_url("/payment-cancel"),
+				},
+			},
+		)
+
+		kwargs.update({"token": order["id"], "api_type": "REST"})
+		create_request_log(kwargs, service_name="PayPal", name=kwargs["token"])
+
+		return next(
+			link["href"] for link in order["links"] if link["rel"] in ("approve", "payer-action")
+		)
+
+	def capture_order(self, order_id):
+		"""Capture an approved order, returns the capture id or None if it was not completed"""
+		response = self.make_rest_request(
+			"POST", f"/v2/checkout/orders/{order_id}/capture", json={}, request_id=order_id
+		)
+
+		if response.get("status") == "COMPLETED":
+			return response["purchase_units"][0]["payments"]["captures"][0]["id"]
+
 	def configure_recurring_payments(self, params, kwargs):
 		# removing the params as we have to setup rucurring payments
 		for param in (
@@ -306,28 +434,13 @@ def confirm_payment(token):
 		custom_redirect_to = None
 		data, params, url = get_paypal_and_transaction_details(token)
 
-		params.update(
-			{
-				"METHOD": "DoExpressCheckoutPayment",
-				"PAYERID": data.get("payerid"),
-				"TOKEN": token,
-				"PAYMENTREQUEST_0_PAYMENTACTION": "SALE",
-				"PAYMENTREQUEST_0_AMT": data.get("amount"),
-				"PAYMENTREQUEST_0_CURRENCYCODE": data.get("currency").upper(),
-			}
-		)
-
-		response = make_post_request(url, data=params)
+		if data.get("api_type") == "REST":
+			transaction = get_rest_transaction(token)
+		else:
+			transaction = get_nvp_transaction(token, data, params, url)
 
-		if response.get("ACK")[0] == "Success":
-			update_integration_request_status(
-				token,
-				{
-					"transaction_id": response.get("PAYMENTINFO_0_TRANSACTIONID")[0],
-					"correlation_id": response.get("CORRELATIONID")[0],
-				},
-				"Completed",
-			)
+		if transaction:
+			update_integration_request_status(token, transaction, "Completed")
 
 			if data.get("reference_doctype") and data.get("reference_docname"):
 				custom_redirect_to = frappe.get_doc(
@@ -347,6 +460,36 @@ def confirm_payment(token):
 		frappe.log_error(frappe.get_traceback())
 
 
+def get_nvp_transaction(token, data, params, url):
+	params.update(
+		{
+			"METHOD": "DoExpressCheckoutPayment",
+			"PAYERID": data.get("payerid"),
+			"TOKEN": token,
+			"PAYMENTREQUEST_0_PAYMENTACTION": "SALE",
+			"PAYMENTREQUEST_0_AMT": data.get("amount"),
+			"PAYMENTREQUEST_0_CURRENCYCODE": data.get("currency").upper(),
+		}
+	)
+
+	response = make_post_request(url, data=params)
+
+	if response.get("ACK")[0] == "Success":
+		return {
+			"transaction_id": response.get("PAYMENTINFO_0_TRANSACTIONID")[0],
+			"correlation_id": response.get("CORRELATIONID")[0],
+		}
+
+
+def get_rest_transaction(token):
+	doc = frappe.get_doc("PayPal Settings")
+	doc.setup_sandbox_env(token)
+
+	transaction_id = doc.capture_order(token)
+	if transaction_id:
+		return {"transaction_id": transaction_id}
+
+
 @frappe.whitelist(allow_guest=True, xss_safe=True)
 def create_recurring_profile(token, payerid):
 	try:
@@ -394,6 +537,7 @@ def create_recurring_profile(token, payerid):
 				},
 				"Completed",
 			)
+			set_payment_gateway_reference("PayPal", response.get("PROFILEID")[0], token)
 
 			if data.get("reference_doctype") and data.get("reference_docname"):
 				data["subscription_id"] = response.get("PROFILEID")[0]
@@ -416,6 +560,12 @@ def create_recurring_profile(token, payerid):
 		frappe.log_error(frappe.get_traceback())
 
 
+def format_amount(amount, currency):
+	"""Format `amount` with the number of decimals PayPal accepts for `currency`"""
+	places = 0 if currency.upper() in ZERO_DECIMAL_CURRENCIES else 2
+	return f"{flt(amount, places):.{places}f}"
+
+
 def update_integration_request_status(token, data, status, error=False, doc=None):
 	if not doc:
 		doc = frappe.get_doc("Integration Request", token)
@@ -443,33 +593,86 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 
 	response = make_post_request(url, data=args)
 
+	if not is_profile_status_updated(response):
+		frappe.throw(_("Failed while amending subscription"))
+
+
+def is_profile_status_updated(response):
 	# error code 11556 indicates profile is not in active state(or already cancelled)
 	# thus could not cancel the subscription.
-	# thus raise an exception only if the error code is not equal to 11556
+	# thus fail only if the error code is not equal to 11556
+	return (
+		response.get("ACK")[0] == "Success" or response.get("L_ERRORCODE0", [None])[0] == "11556"
+	)
 
-	if response.get("ACK")[0] != "Success" and response.get("L_ERRORCODE0", [])[0] != "11556":
-		frappe.throw(_("Failed while amending subscription"))
+
+@frappe.whitelist()
+def manage_recurring_payment_profiles(profile_ids, action):
+	"""Suspend, Reactivate or Cancel many profiles from a background job, progress is published
+	to the caller"""
+	frappe.only_for("System Manager")
+	if action not in ("Suspend", "Reactivate", "Cancel"):
+		frappe.throw(_("Invalid action {0}").format(action))
+
+	frappe.enqueue(
+		"payments.payment_gateways.doctype.paypal_settings.paypal_settings.bulk_manage_recurring_payment_profiles",
+		queue="long",
+		timeout=3600,
+		profile_ids=frappe.parse_json(profile_ids),
+		action=action,
+	)
+
+
+def bulk_manage_recurring_payment_profiles(profile_ids, action):
+	"""Apply `action` to `profile_ids` concurrently, at most `paypal_rate_limit` calls per second
+
+	The response or the error is recorded on the Integration Request the profile was created
+	with, profiles created before those were indexed get a new request."""
+	params, url = frappe.get_doc("PayPal Settings").get_paypal_params_and_url()
+
+	def update_profile(profile_id):
+		response = fetch(
+			"POST",
+			url,
+			data=dict(
+				params,
+				METHOD="ManageRecurringPaymentsProfileStatus",
+				PROFILEID=profile_id,
+				ACTION=action,
+			),
+		)
+
+		if not is_profile_status_updated(response):
+			raise frappe.ValidationError(response.get("L_LONGMESSAGE0", [str(response)])[0])
+
+		return response
+
+	return run_bulk_requests(
+		"PayPal",
+		f"{action} Recurring Payments Profile",
+		profile_ids,
+		update_profile,
+		rate_limit=frappe.conf.get("paypal_rate_limit") or RATE_LIMIT,
+		title=_("Updating PayPal Recurring Payments Profiles"),
+		get_integration_request=partial(get_integration_request_by_reference, "PayPal"),
+		status="Cancelled" if action == "Cancel" else None,
+	)
 
 
 @frappe.whitelist(allow_guest=True)
 def ipn_handler():
+	"""Store the IPN and acknowledge it, validation happens in the queued job
+
+	PayPal resends an IPN until it is acknowledged, resent messages carry the same
+	`ipn_track_id` and are dropped here."""
 	try:
 		data = frappe.local.form_dict
-
-		validate_ipn_request(data)
-
 		data.update({"payment_gateway": "PayPal"})
+		ipn_id = get_ipn_id(data)
 
-		doc = frappe.get_doc(
-			{
-				"data": json.dumps(frappe.local.form_dict),
-				"doctype": "Integration Request",
-				"request_description": "Subscription Notification",
-				"is_remote_request": 1,
-				"status": "Queued",
-			}
-		).insert(ignore_permissions=True)
-		frappe.db.commit()
+		doc = insert_webhook_request("PayPal", ipn_id, json.dumps(data), "Subscription Notification")
+		if not doc:
+			return
 
 		frappe.enqueue(
 			method="payments.payment_gateways.doctype.paypal_settings.paypal_settings.handle_subscription_notification",
@@ -479,12 +682,19 @@ def ipn_handler():
 			**{"doctype": "Integration Request", "docname": doc.name},
 		)
 
-	except frappe.InvalidStatusError:
-		pass
 	except Exception as e:
 		frappe.log(frappe.log_error(title=e))
 
 
+def get_ipn_id(data):
+	if data.get("ipn_track_id"):
+		return f"ipn:{data.ipn_track_id}"
+
+	if data.get("txn_id"):
+		# a transaction gets one IPN per payment status (Pending, Completed, Refunded...)
+		return f"txn:{data.txn_id}:{data.get('payment_status')}"
+
+
 def validate_ipn_request(data):
 	def _throw():
 		frappe.throw(_("In Valid Request"), exc=frappe.InvalidStatusError)
@@ -510,4 +720,12 @@ def validate_ipn_request(data):
 
 
 def handle_subscription_notification(doctype, docname):
+	integration_request = frappe.get_doc(doctype, docname)
+
+	try:
+		validate_ipn_request(frappe._dict(json.loads(integration_request.data)))
+	except frappe.InvalidStatusError:
+		integration_request.db_set("status", "Cancelled", update_modified=False)
+		return
+
 	call_hook_method("handle_subscription_notification", doctype=doctype, docname=docname)
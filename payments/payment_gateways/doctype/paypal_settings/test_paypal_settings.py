@@ -0,0 +1,33 @@
+# Copyright (c) 2024, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+
+import unittest
+
+import frappe
+
+from payments.payment_gateways.doctype.paypal_settings.paypal_settings import (
+	format_amount,
+	get_ipn_id,
+)
+
+
+class TestPayPalSettings(unittest.TestCase):
+	def test_ipn_id_from_track_id(self):
+		data = frappe._dict(ipn_track_id="3f1b2c", txn_id="8XY", payment_status="Completed")
+		self.assertEqual(get_ipn_id(data), "ipn:3f1b2c")
+
+	def test_ipn_id_per_transaction_status(self):
+		pending = frappe._dict(txn_id="8XY", payment_status="Pending")
+		completed = frappe._dict(txn_id="8XY", payment_status="Completed")
+
+		self.assertEqual(get_ipn_id(pending), "txn:8XY:Pending")
+		self.assertNotEqual(get_ipn_id(pending), get_ipn_id(completed))
+
+	def test_no_ipn_id(self):
+		self.assertIsNone(get_ipn_id(frappe._dict(payment_status="Completed")))
+
+	def test_amount_decimals_per_currency(self):
+		self.assertEqual(format_amount(0.1 + 0.2, "USD"), "0.30")
+		self.assertEqual(format_amount(100, "eur"), "100.00")
+		self.assertEqual(format_amount(1500.4, "JPY"), "1500")
+		self.assertEqual(format_amount(1500.6, "HUF"), "1501")
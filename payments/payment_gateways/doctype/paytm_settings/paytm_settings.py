@@ -5,7 +5,6 @@ import json
 from urllib.parse import urlencode
 
 import frappe
-import requests
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
@@ -17,10 +16,13 @@ from frappe.utils import (
 	get_request_site_address,
 	get_url,
 )
-from frappe.utils.password import get_decrypted_password
-from paytmchecksum import generateSignature, verifySignature
 
-from payments.utils import create_payment_gateway
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_cached_decrypted_password,
+	transport,
+)
 
 
 class PaytmSettings(Document):
@@ -30,6 +32,9 @@ class PaytmSettings(Document):
 		create_payment_gateway("Paytm")
 		call_hook_method("payment_gateway_enabled", gateway="Paytm")
 
+	def on_update(self):
+		clear_payment_gateway_cache()
+
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
 			frappe.throw(
@@ -52,7 +57,11 @@ def get_paytm_config():
 
 	paytm_config = frappe.db.get_singles_dict("Paytm Settings")
 	paytm_config.update(
-		dict(merchant_key=get_decrypted_password("Paytm Settings", "Paytm Settings", "merchant_key"))
+		dict(
+			merchant_key=get_cached_decrypted_password(
+				"Paytm Settings", "Paytm Settings", "merchant_key"
+			)
+		)
 	)
 
 	if cint(paytm_config.staging):
@@ -75,6 +84,7 @@ def get_paytm_config():
 
 
 def get_paytm_params(payment_details, order_id, paytm_config):
+	from paytmchecksum import generateSignature
 
 	# initialize a dictionary
 	paytm_params = dict()
@@ -108,6 +118,8 @@ def get_paytm_params(payment_details, order_id, paytm_config):
 @frappe.whitelist(allow_guest=True)
 def verify_transaction(**paytm_params):
 	"""Verify checksum for received data in the callback and then verify the transaction"""
+	from paytmchecksum import verifySignature
+
 	paytm_config = get_paytm_config()
 	is_valid_checksum = False
 
@@ -134,6 +146,8 @@ def verify_transaction(**paytm_params):
 
 def verify_transaction_status(paytm_config, order_id):
 	"""Verify transaction completion after checksum has been verified"""
+	from paytmchecksum import generateSignature
+
 	paytm_params = dict(MID=paytm_config.merchant_id, ORDERID=order_id)
 
 	checksum = generateSignature(paytm_params, paytm_config.merchant_key)
@@ -142,7 +156,9 @@ def verify_transaction_status(paytm_config, order_id):
 	post_data = json.dumps(paytm_params)
 	url = paytm_config.transaction_status_url
 
-	response = requests.post(url, data=post_data, headers={"Content-type": "application/json"}).json()
+	response = transport.request(
+		"POST", url, data=post_data, headers={"Content-type": "application/json"}
+	).json()
 	finalize_request(order_id, response)
 
 
@@ -57,34 +57,89 @@ Example:
 payment_status - payment gateway will put payment status on callback.
 For razorpay payment status is Authorized
 
+### 4. Webhooks
+
+Add a webhook on the Razorpay dashboard for `payment.authorized`, `payment.captured`,
+`payment.failed` and `order.paid` pointing to
+
+	/api/method/payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.razorpay_webhook
+
+and set the same secret as Webhook Secret in Razorpay Settings.
+
 """
 
 import hashlib
 import hmac
 import json
+import time
+from functools import partial
 from urllib.parse import urlencode
 
 import frappe
-import razorpay
 from frappe import _
-from frappe.integrations.utils import (
-	create_request_log,
-	make_get_request,
-	make_post_request,
-)
+from redis.exceptions import LockError
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, get_timestamp, get_url
+from frappe.query_builder import Case
+from frappe.query_builder.functions import Count, Min
+from frappe.utils import (
+	call_hook_method,
+	cint,
+	get_timestamp,
+	get_url,
+	now,
+	now_datetime,
+	time_diff_in_seconds,
+)
+
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_cached_password,
+	get_integration_request_by_reference,
+	get_payment_gateway_controller,
+	insert_webhook_request,
+	integration_request_update,
+	set_payment_gateway_reference,
+)
+from payments.utils import transport
+from payments.utils.async_client import fan_out
+from payments.utils.bulk import run_bulk_requests
+from payments.utils.transport import get_session, make_get_request, make_post_request
+
+# capture_payment runs from the scheduler, see hooks.py
+CAPTURE_PAGE_SIZE = 100
+CAPTURE_LOCK_TIMEOUT = 30 * 60
+
+# requests per second for bulk jobs, Razorpay throttles bursts with 429s
+RATE_LIMIT = 10
 
-from payments.utils import create_payment_gateway
+# seconds during which an unpaid order is handed out again, see create_order
+ORDER_REUSE_TTL = 15 * 60
+
+# Integration Request status set by each webhook event, see razorpay_webhook
+WEBHOOK_EVENT_STATUS = {
+	"payment.authorized": "Authorized",
+	"payment.captured": "Completed",
+	"order.paid": "Completed",
+	"payment.failed": "Failed",
+}
+# a webhook never moves a request back, events may arrive out of order
+STATUS_RANK = {"Queued": 0, "Failed": 0, "Authorized": 1, "Completed": 2}
+PAYMENT_STATUS = {"authorized": "Authorized", "captured": "Completed", "failed": "Failed"}
 
 
 class RazorpaySettings(Document):
 	supported_currencies = ["INR"]
 
 	def init_client(self):
+		import razorpay
+
 		if self.api_key:
-			secret = self.get_password(fieldname="api_secret", raise_exception=False)
-			self.client = razorpay.Client(auth=(self.api_key, secret))
+			secret = get_cached_password(self, "api_secret", raise_exception=False)
+			self.client = razorpay.Client(
+				auth=(self.api_key, secret), session=get_session("https://api.razorpay.com")
+			)
 
 	def validate(self):
 		create_payment_gateway("Razorpay")
@@ -92,6 +147,9 @@ class RazorpaySettings(Document):
 		if not self.flags.ignore_mandatory:
 			self.validate_razorpay_credentails()
 
+	def on_update(self):
+		clear_payment_gateway_cache()
+
 	def validate_razorpay_credentails(self):
 		if self.api_key and self.api_secret:
 			try:
@@ -125,26 +183,45 @@ class RazorpaySettings(Document):
 		        },
 		        "quantity": 1 (The total amount is calculated as item.amount * quantity)
 		}
+
+		Addons are created concurrently. Returns one `frappe._dict(addon, id, error)` per addon,
+		in the order given, so that only the failed ones can be retried:
+
+		        failed = [r.addon for r in results if r.error]
+		        controller.setup_addon(settings, subscription_id=subscription_id, addons=failed)
 		"""
 		url = "https://api.razorpay.com/v1/subscriptions/{}/addons".format(kwargs.get("subscription_id"))
+		addons = kwargs.get("addons") or []
 
-		try:
-			if not frappe.conf.converted_rupee_to_paisa:
-				convert_rupee_to_paisa(**kwargs)
+		def create_addon(addon):
+			resp = transport.fetch(
+				"POST",
+				url,
+				auth=(settings.api_key, settings.api_secret),
+				data=json.dumps(addon),
+				headers={"content-type": "application/json"},
+			)
+			if not resp.get("id"):
+				raise frappe.ValidationError(str(resp))
 
-			for addon in kwargs.get("addons"):
-				resp = make_post_request(
-					url,
-					auth=(settings.api_key, settings.api_secret),
-					data=json.dumps(addon),
-					headers={"content-type": "application/json"},
+			return resp
+
+		results = []
+		for addon, result in zip(addons, fan_out(create_addon, get_addons_in_paisa(addons))):
+			if result.error:
+				frappe.log_error(
+					message=result.traceback, title="Razorpay Failed while creating subscription"
 				)
-				if not resp.get("id"):
-					frappe.log_error(message=str(resp), title="Razorpay Failed while creating subscription")
-		except Exception:
-			frappe.log_error()
-			# failed
-			pass
+
+			results.append(
+				frappe._dict(
+					addon=addon,
+					id=result.result.get("id") if result.result else None,
+					error=str(result.error) if result.error else None,
+				)
+			)
+
+		return results
 
 	def setup_subscription(self, settings, **kwargs):
 		start_date = (
@@ -163,8 +240,7 @@ class RazorpaySettings(Document):
 			subscription_details["start_at"] = cint(start_date)
 
 		if kwargs.get("addons"):
-			convert_rupee_to_paisa(**kwargs)
-			subscription_details.update({"addons": kwargs.get("addons")})
+			subscription_details.update({"addons": get_addons_in_paisa(kwargs.get("addons"))})
 
 		try:
 			resp = make_post_request(
@@ -195,9 +271,37 @@ class RazorpaySettings(Document):
 
 	def get_payment_url(self, **kwargs):
 		integration_request = create_request_log(kwargs, service_name="Razorpay")
+		if kwargs.get("subscription_id"):
+			set_payment_gateway_reference("Razorpay", kwargs["subscription_id"], integration_request.name)
+
 		return get_url(f"./razorpay_checkout?token={integration_request.name}")
 
 	def create_order(self, **kwargs):
+		"""Create a Razorpay order, or return the open order created for the same reference,
+		amount and currency within the last `razorpay_order_reuse_ttl` seconds"""
+		key = get_order_cache_key(kwargs)
+		order = get_reusable_order(key)
+		if order:
+			return order
+
+		cache = frappe.cache()
+		try:
+			# concurrent requests for the same order wait for the first one instead of creating more
+			with cache.lock(cache.make_key(f"{key}_lock"), timeout=60, blocking_timeout=30):
+				order = get_reusable_order(key)
+				if not order:
+					order = self._create_order(**kwargs)
+					if order:
+						ttl = cint(frappe.conf.get("razorpay_order_reuse_ttl")) or ORDER_REUSE_TTL
+						cache.set_value(key, order, expires_in_sec=ttl)
+						# the Integration Request of the order is gone if this request fails
+						frappe.db.after_rollback.add(lambda: cache.delete_value(key))
+		except LockError:
+			frappe.throw(_("Could not create razorpay order"))
+
+		return order
+
+	def _create_order(self, **kwargs):
 		# Creating Orders https://razorpay.com/docs/api/orders/
 
 		# convert rupees to paisa
@@ -217,13 +321,11 @@ class RazorpaySettings(Document):
 			try:
 				order = make_post_request(
 					"https://api.razorpay.com/v1/orders",
-					auth=(
-						self.api_key,
-						self.get_password(fieldname="api_secret", raise_exception=False),
-					),
+					auth=(self.api_key, get_cached_password(self, "api_secret", raise_exception=False)),
 					data=payment_options,
 				)
 				order["integration_request"] = integration_request.name
+				set_payment_gateway_reference("Razorpay", order.get("id"), integration_request.name)
 				return order  # Order returned to be consumed by razorpay.js
 			except Exception:
 				frappe.log(frappe.get_traceback())
@@ -234,7 +336,10 @@ class RazorpaySettings(Document):
 
 		try:
 			self.integration_request = frappe.get_doc("Integration Request", self.data.token)
-			self.integration_request.update_status(self.data, "Queued")
+			# a repeated callback must not reopen a payment that was already captured
+			if self.integration_request.status != "Completed":
+				self.integration_request.status = "Queued"
+			self.integration_request.update_status(self.data, self.integration_request.status)
 			return self.authorize_payment()
 
 		except Exception:
@@ -257,14 +362,33 @@ class RazorpaySettings(Document):
 		"""
 		data = json.loads(self.integration_request.data)
 		settings = self.get_settings(data)
+		status = None
+
+		set_payment_gateway_reference(
+			"Razorpay", self.data.razorpay_payment_id, self.integration_request.name
+		)
 
 		try:
-			resp = make_get_request(
-				f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
-				auth=(settings.api_key, settings.api_secret),
-			)
+			if get_webhook_status(data, self.data.razorpay_payment_id) in ("authorized", "captured"):
+				# the webhook got here first, no need to ask Razorpay again
+				resp = {"status": data.get("razorpay_status")}
+				status = 200
+			elif self.flags.signature_verified:
+				# the order signature proves the payment was authorized, the actual status is
+				# confirmed in the background by confirm_order_payment
+				resp = {"status": "authorized"}
+				status = 200
+			else:
+				resp = make_get_request(
+					f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
+					auth=(settings.api_key, settings.api_secret),
+				)
 
-			if resp.get("status") == "authorized":
+			if self.integration_request.status == "Completed":
+				# captured by capture_payment after an earlier callback
+				self.flags.status_changed_to = "Completed"
+
+			elif resp.get("status") == "authorized":
 				self.integration_request.update_status(data, "Authorized")
 				self.flags.status_changed_to = "Authorized"
 
@@ -287,7 +411,7 @@ class RazorpaySettings(Document):
 		except Exception:
 			frappe.log_error()
 
-		status = frappe.flags.integration_request.status_code
+		status = status or frappe.flags.integration_request.status_code
 
 		redirect_to = data.get("redirect_to") or None
 		redirect_message = data.get("redirect_message") or None
@@ -323,7 +447,7 @@ class RazorpaySettings(Document):
 		settings = frappe._dict(
 			{
 				"api_key": self.api_key,
-				"api_secret": self.get_password(fieldname="api_secret", raise_exception=False),
+				"api_secret": get_cached_password(self, "api_secret", raise_exception=False),
 			}
 		)
 
@@ -345,6 +469,7 @@ class RazorpaySettings(Document):
 				f"https://api.razorpay.com/v1/subscriptions/{subscription_id}/cancel",
 				auth=(settings.api_key, settings.api_secret),
 			)
+			return resp
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
 
@@ -370,43 +495,234 @@ def capture_payment(is_sandbox=False, sanbox_response=None):
 	where T is the day on which payment is captured.
 
 	Note: Attempting to capture a payment whose status is not authorized will produce an error.
+
+	Authorized requests are read in pages through a (creation, name) cursor and captured
+	concurrently, each page is committed before the next one is read. A cache lock keeps
+	overlapping scheduler runs from capturing the same payments.
 	"""
-	controller = frappe.get_doc("Razorpay Settings")
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key("razorpay_capture_payment"), timeout=CAPTURE_LOCK_TIMEOUT)
+	if not lock.acquire(blocking=False):
+		return
 
-	for doc in frappe.get_all(
-		"Integration Request",
-		filters={"status": "Authorized", "integration_request_service": "Razorpay"},
-		fields=["name", "data"],
-	):
+	try:
+		metrics = capture_authorized_payments(is_sandbox, sanbox_response)
+		cache.set_value("razorpay_capture_metrics", metrics)
+		frappe.logger("payments").info({"razorpay_capture": metrics})
+	finally:
 		try:
-			if is_sandbox:
-				resp = sanbox_response
+			lock.release()
+		except Exception:
+			# the lock expired while capturing, another run may already hold it
+			pass
+
+
+def capture_authorized_payments(is_sandbox=False, sanbox_response=None):
+	controller = frappe.get_doc("Razorpay Settings")
+	page_size = cint(frappe.conf.get("razorpay_capture_page_size")) or CAPTURE_PAGE_SIZE
+	started_at = time.monotonic()
+
+	metrics = get_capture_backlog()
+	metrics.update(captured=0, failed=0, gateway_seconds=0.0)
+
+	def capture(payment):
+		call_started_at = time.monotonic()
+		if is_sandbox:
+			resp = sanbox_response
+		else:
+			auth = (payment.settings.api_key, payment.settings.api_secret)
+			url = f"https://api.razorpay.com/v1/payments/{payment.razorpay_payment_id}"
+
+			if payment.razorpay_status == "authorized":
+				resp = {"status": "authorized"}
 			else:
-				data = json.loads(doc.data)
-				settings = controller.get_settings(data)
+				resp = transport.fetch("GET", url, auth=auth)
 
-				resp = make_get_request(
-					"https://api.razorpay.com/v1/payments/{}".format(data.get("razorpay_payment_id")),
-					auth=(settings.api_key, settings.api_secret),
-					data={"amount": data.get("amount")},
+			if resp.get("status") == "authorized":
+				resp = transport.fetch(
+					"POST", f"{url}/capture", auth=auth, data={"amount": payment.amount}
 				)
 
-				if resp.get("status") == "authorized":
-					resp = make_post_request(
-						"https://api.razorpay.com/v1/payments/{}/capture".format(data.get("razorpay_payment_id")),
-						auth=(settings.api_key, settings.api_secret),
-						data={"amount": data.get("amount")},
-					)
+		return resp, time.monotonic() - call_started_at
+
+	cursor = None
+	while True:
+		page = get_authorized_payments(cursor, page_size)
+		if not page:
+			break
+
+		cursor = page[-1]
+		payments = []
+		for doc in page:
+			data = json.loads(doc.data or "{}")
+			payments.append(
+				frappe._dict(
+					name=doc.name,
+					razorpay_payment_id=data.get("razorpay_payment_id"),
+					razorpay_status=get_webhook_status(data, data.get("razorpay_payment_id")),
+					amount=data.get("amount"),
+					settings=controller.get_settings(data),
+					data=data,
+				)
+			)
+
+		captured = []
+		for result in fan_out(capture, payments):
+			if result.error:
+				metrics.failed += 1
+				frappe.db.set_value(
+					"Integration Request",
+					result.item.name,
+					{"status": "Failed", "error": result.traceback},
+				)
+				frappe.log_error(result.traceback, f"{result.item.name} Failed")
+				continue
 
+			resp, seconds = result.result
+			metrics.gateway_seconds += seconds
 			if resp.get("status") == "captured":
-				frappe.db.set_value("Integration Request", doc.name, "status", "Completed")
+				captured.append(result.item)
+
+		if captured:
+			# the captured status is recorded too, so that later callbacks and runs never
+			# take the payment for authorized again
+			IntegrationRequest = frappe.qb.DocType("Integration Request")
+			captured_data = Case()
+			for payment in captured:
+				payment.data.update(
+					razorpay_webhook_payment_id=payment.razorpay_payment_id, razorpay_status="captured"
+				)
+				captured_data = captured_data.when(
+					IntegrationRequest.name == payment.name, json.dumps(payment.data)
+				)
 
-		except Exception:
-			doc = frappe.get_doc("Integration Request", doc.name)
-			doc.status = "Failed"
-			doc.error = frappe.get_traceback()
-			doc.save()
-			frappe.log_error(doc.error, f"{doc.name} Failed")
+			frappe.qb.update(IntegrationRequest).set(IntegrationRequest.status, "Completed").set(
+				IntegrationRequest.data, captured_data
+			).set(IntegrationRequest.modified, now()).where(
+				IntegrationRequest.name.isin([payment.name for payment in captured])
+			).run()
+			metrics.captured += len(captured)
+
+		frappe.db.commit()
+
+		if len(page) < page_size:
+			break
+
+	metrics.duration_seconds = time.monotonic() - started_at
+	return metrics
+
+
+def get_authorized_payments(cursor, page_size):
+	"""Return the next page of authorized Razorpay requests after `cursor`"""
+	IntegrationRequest = frappe.qb.DocType("Integration Request")
+	query = (
+		frappe.qb.from_(IntegrationRequest)
+		.select(IntegrationRequest.name, IntegrationRequest.creation, IntegrationRequest.data)
+		.where(IntegrationRequest.status == "Authorized")
+		.where(IntegrationRequest.integration_request_service == "Razorpay")
+		.orderby(IntegrationRequest.creation)
+		.orderby(IntegrationRequest.name)
+		.limit(page_size)
+	)
+
+	if cursor:
+		query = query.where(
+			(IntegrationRequest.creation > cursor.creation)
+			| (
+				(IntegrationRequest.creation == cursor.creation)
+				& (IntegrationRequest.name > cursor.name)
+			)
+		)
+
+	return query.run(as_dict=True)
+
+
+def get_order_cache_key(kwargs):
+	reference = [
+		kwargs.get("reference_doctype"),
+		kwargs.get("reference_docname"),
+		kwargs.get("receipt"),
+		kwargs.get("amount"),
+		kwargs.get("currency", "INR"),
+	]
+	digest = hashlib.sha256(frappe.as_json(reference).encode()).hexdigest()
+	return f"razorpay_order:{digest}"
+
+
+def get_reusable_order(key):
+	"""Return the cached order if nobody has paid for it yet"""
+	order = frappe.cache().get_value(key)
+	if not order:
+		return
+
+	status = frappe.db.get_value("Integration Request", order.get("integration_request"), "status")
+	# no status yet: the request creating the order has not committed, the order is still open
+	if status in (None, "Queued"):
+		return order
+
+	frappe.cache().delete_value(key)
+
+
+def get_webhook_status(data, razorpay_payment_id):
+	"""Return the payment status last reported by the webhook for this payment"""
+	if razorpay_payment_id and data.get("razorpay_webhook_payment_id") == razorpay_payment_id:
+		return data.get("razorpay_status")
+
+
+def get_capture_backlog():
+	"""Return the number of payments waiting for capture and the age of the oldest one"""
+	IntegrationRequest = frappe.qb.DocType("Integration Request")
+	backlog, oldest = (
+		frappe.qb.from_(IntegrationRequest)
+		.select(Count(IntegrationRequest.name), Min(IntegrationRequest.creation))
+		.where(IntegrationRequest.status == "Authorized")
+		.where(IntegrationRequest.integration_request_service == "Razorpay")
+		.run()[0]
+	)
+
+	return frappe._dict(
+		backlog=backlog,
+		oldest_authorized_seconds=time_diff_in_seconds(now_datetime(), oldest) if oldest else 0,
+	)
+
+
+@frappe.whitelist()
+def cancel_subscriptions(subscription_ids):
+	"""Cancel many subscriptions from a background job, progress is published to the caller"""
+	frappe.only_for("System Manager")
+
+	frappe.enqueue(
+		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.bulk_cancel_subscriptions",
+		queue="long",
+		timeout=3600,
+		subscription_ids=frappe.parse_json(subscription_ids),
+	)
+
+
+def bulk_cancel_subscriptions(subscription_ids):
+	"""Cancel `subscription_ids` concurrently, at most `razorpay_rate_limit` calls per second
+
+	The response or the error is recorded on the Integration Request the subscription was
+	created with, subscriptions created before those were indexed get a new request."""
+	settings = frappe.get_doc("Razorpay Settings").get_settings({})
+
+	def cancel(subscription_id):
+		return transport.fetch(
+			"POST",
+			f"https://api.razorpay.com/v1/subscriptions/{subscription_id}/cancel",
+			auth=(settings.api_key, settings.api_secret),
+		)
+
+	return run_bulk_requests(
+		"Razorpay",
+		"Cancel Subscription",
+		subscription_ids,
+		cancel,
+		rate_limit=frappe.conf.get("razorpay_rate_limit") or RATE_LIMIT,
+		title=_("Cancelling Razorpay Subscriptions"),
+		get_integration_request=partial(get_integration_request_by_reference, "Razorpay"),
+		status="Cancelled",
+	)
 
 
 @frappe.whitelist(allow_guest=True)
@@ -451,9 +767,59 @@ def order_payment_success(integration_request, params):
 	controller.integration_request = integration
 	controller.data = frappe._dict(data)
 
+	controller.flags.signature_verified = verify_order_signature(controller, integration, params)
+
 	# Authorize payment
 	controller.authorize_payment()
 
+	if controller.flags.signature_verified:
+		frappe.enqueue(
+			"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.confirm_order_payment",
+			queue="short",
+			enqueue_after_commit=True,
+			integration_request=integration.name,
+			razorpay_payment_id=params.get("razorpay_payment_id"),
+		)
+
+
+def verify_order_signature(controller, integration, params):
+	"""Check the checkout signature, `hmac_sha256(order_id + "|" + payment_id, api_secret)`
+
+	Returns False when the order is not known to belong to this Integration Request, the
+	caller then falls back to fetching the payment from Razorpay. A wrong signature throws."""
+	order_id = params.get("razorpay_order_id")
+	payment_id = params.get("razorpay_payment_id")
+	signature = params.get("razorpay_signature")
+	if not (order_id and payment_id and signature):
+		return False
+
+	if get_integration_request_by_reference("Razorpay", order_id) != integration.name:
+		return False
+
+	settings = controller.get_settings(controller.data)
+	return controller.verify_signature(f"{order_id}|{payment_id}", signature, settings.api_secret)
+
+
+def confirm_order_payment(integration_request, razorpay_payment_id):
+	"""Fetch the status of a payment authorized through its order signature
+
+	Only needed when the webhook has not reported the payment yet."""
+	integration_request = frappe.get_doc("Integration Request", integration_request)
+	data = json.loads(integration_request.data)
+	if get_webhook_status(data, razorpay_payment_id):
+		return
+
+	settings = frappe.get_doc("Razorpay Settings").get_settings(data)
+	resp = make_get_request(
+		f"https://api.razorpay.com/v1/payments/{razorpay_payment_id}",
+		auth=(settings.api_key, settings.api_secret),
+	)
+
+	if resp.get("status") == "captured":
+		update_integration_request_from_payment(integration_request.name, resp, "Completed")
+	elif resp.get("status") != "authorized":
+		frappe.log_error(message=str(resp), title="Razorpay Payment not authorized")
+
 
 @frappe.whitelist(allow_guest=True)
 def order_payment_failure(integration_request, params):
@@ -469,32 +835,31 @@ def order_payment_failure(integration_request, params):
 	integration.update_status(params, integration.status)
 
 
-def convert_rupee_to_paisa(**kwargs):
-	for addon in kwargs.get("addons"):
-		addon["item"]["amount"] *= 100
+def get_addons_in_paisa(addons):
+	"""Return copies of `addons` with the item amount converted from rupees to paisa"""
+	converted = []
+	for addon in addons:
+		addon = frappe._dict(addon, item=frappe._dict(addon["item"]))
+		addon.item.amount *= 100
+		converted.append(addon)
 
-	frappe.conf.converted_rupee_to_paisa = True
+	return converted
 
 
 @frappe.whitelist(allow_guest=True)
 def razorpay_subscription_callback():
+	"""Store the notification and acknowledge it, validation happens in the queued job
+
+	Razorpay redelivers a notification until it is acknowledged, redeliveries carry the same
+	`X-Razorpay-Event-Id` and are dropped here."""
 	try:
 		data = frappe.local.form_dict
-
-		validate_payment_callback(data)
-
 		data.update({"payment_gateway": "Razorpay"})
+		event_id = frappe.get_request_header("X-Razorpay-Event-Id")
 
-		doc = frappe.get_doc(
-			{
-				"data": json.dumps(frappe.local.form_dict),
-				"doctype": "Integration Request",
-				"request_description": "Subscription Notification",
-				"is_remote_request": 1,
-				"status": "Queued",
-			}
-		).insert(ignore_permissions=True)
-		frappe.db.commit()
+		doc = insert_webhook_request("Razorpay", event_id, json.dumps(data), "Subscription Notification")
+		if not doc:
+			return
 
 		frappe.enqueue(
 			method="payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.handle_subscription_notification",
@@ -504,8 +869,6 @@ def razorpay_subscription_callback():
 			**{"doctype": "Integration Request", "docname": doc.name},
 		)
 
-	except frappe.InvalidStatusError:
-		pass
 	except Exception as e:
 		frappe.log(frappe.log_error(title=e))
 
@@ -514,7 +877,9 @@ def validate_payment_callback(data):
 	def _throw():
 		frappe.throw(_("Invalid Subscription"), exc=frappe.InvalidStatusError)
 
-	subscription_id = data.get("payload").get("subscription").get("entity").get("id")
+	subscription_id = (
+		(data.get("payload") or {}).get("subscription", {}).get("entity", {}).get("id")
+	)
 
 	if not (subscription_id):
 		_throw()
@@ -533,4 +898,94 @@ def validate_payment_callback(data):
 
 
 def handle_subscription_notification(doctype, docname):
+	integration_request = frappe.get_doc(doctype, docname)
+
+	try:
+		validate_payment_callback(frappe._dict(json.loads(integration_request.data)))
+	except frappe.InvalidStatusError:
+		integration_request.db_set("status", "Cancelled", update_modified=False)
+		return
+
 	call_hook_method("handle_subscription_notification", doctype=doctype, docname=docname)
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def razorpay_webhook():
+	"""Receives `payment.authorized`, `payment.captured`, `payment.failed` and `order.paid`
+
+	The Integration Request is found through the Payment Gateway Reference of the payment or
+	order and the reported status is recorded on it. The user facing callbacks and
+	`capture_payment` then reuse it instead of fetching the payment from Razorpay.
+	"""
+	controller = get_payment_gateway_controller("Razorpay")
+	secret = get_cached_password(controller, "webhook_secret", raise_exception=False)
+	signature = frappe.get_request_header("X-Razorpay-Signature")
+	if not (secret and signature):
+		frappe.throw(_("Razorpay Signature Verification Failed"), exc=frappe.PermissionError)
+
+	controller.verify_signature(frappe.request.get_data(as_text=True), signature, secret)
+
+	event = frappe.parse_json(frappe.request.get_data(as_text=True))
+	status = WEBHOOK_EVENT_STATUS.get(event.get("event"))
+	payment = event.get("payload", {}).get("payment", {}).get("entity")
+	if not (status and payment):
+		return
+
+	integration_request = get_integration_request_for_payment(payment)
+	if not integration_request:
+		return
+
+	update_integration_request_from_payment(integration_request, payment, status)
+
+
+def get_integration_request_for_payment(payment):
+	integration_request = get_integration_request_by_reference(
+		"Razorpay", payment.get("id")
+	) or get_integration_request_by_reference("Razorpay", payment.get("order_id"))
+
+	if not integration_request:
+		# checkout page payments carry the Integration Request name in their notes
+		token = (payment.get("notes") or {}).get("token")
+		if token and frappe.db.exists(
+			"Integration Request", {"name": token, "integration_request_service": "Razorpay"}
+		):
+			integration_request = token
+
+	if integration_request:
+		set_payment_gateway_reference("Razorpay", payment.get("id"), integration_request)
+
+	return integration_request
+
+
+def update_integration_request_from_payment(integration_request, payment, status):
+	"""Record the status Razorpay reported for the payment on the Integration Request
+
+	A Queued request only gets the status recorded in its data, `authorize_payment` moves it
+	when the payer returns, so that the reference document is always notified before the
+	payment is captured. Payments nobody returns for are never captured and Razorpay
+	refunds them."""
+	integration_request = frappe.get_doc("Integration Request", integration_request)
+	data = json.loads(integration_request.data or "{}")
+
+	current = integration_request.status
+	if current == "Queued":
+		current = PAYMENT_STATUS.get(get_webhook_status(data, payment.get("id")), current)
+
+	if STATUS_RANK.get(status, 0) < STATUS_RANK.get(current, 0):
+		return
+
+	data.update(
+		{
+			"razorpay_webhook_payment_id": payment.get("id"),
+			"razorpay_status": payment.get("status"),
+		}
+	)
+	if status != "Failed" or not data.get("razorpay_payment_id"):
+		data["razorpay_payment_id"] = payment.get("id")
+
+	with integration_request_update(integration_request) as changes:
+		changes.data = json.dumps(data)
+		if integration_request.status != "Queued":
+			changes.status = status
+			if status == "Failed":
+				changes.error = payment.get("error_description")
@@ -0,0 +1,231 @@
+# Copyright (c) 2024, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+
+import hashlib
+import hmac
+import itertools
+import json
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+from payments.payment_gateways.doctype.razorpay_settings.razorpay_settings import (
+	capture_payment,
+	get_addons_in_paisa,
+	get_authorized_payments,
+	get_order_cache_key,
+	razorpay_webhook,
+	verify_order_signature,
+)
+
+MODULE = "payments.payment_gateways.doctype.razorpay_settings.razorpay_settings"
+
+
+def sign(body, secret):
+	return hmac.new(secret.encode(), body.encode(), hashlib.sha256).hexdigest()
+
+
+class TestRazorpaySettings(unittest.TestCase):
+	def test_addons_in_paisa(self):
+		addons = [{"item": {"name": "Extra seat", "amount": 250, "currency": "INR"}, "quantity": 2}]
+
+		converted = get_addons_in_paisa(addons)
+
+		self.assertEqual(converted[0].item.amount, 25000)
+		self.assertEqual(converted[0].item.name, "Extra seat")
+		self.assertEqual(converted[0].quantity, 2)
+
+	def test_addons_in_paisa_leaves_input_unchanged(self):
+		addons = [{"item": {"name": "Extra seat", "amount": 250}}]
+
+		get_addons_in_paisa(addons)
+		get_addons_in_paisa(addons)
+
+		self.assertEqual(addons[0]["item"]["amount"], 250)
+
+
+class TestRazorpaySignatures(unittest.TestCase):
+	def setUp(self):
+		self.controller = frappe.new_doc("Razorpay Settings")
+
+	def test_valid_signature(self):
+		body = '{"event": "payment.captured"}'
+		self.assertTrue(
+			self.controller.verify_signature(body, sign(body, "_Test Secret"), "_Test Secret")
+		)
+
+	def test_invalid_signature(self):
+		body = '{"event": "payment.captured"}'
+		with self.assertRaises(frappe.PermissionError):
+			self.controller.verify_signature(body, sign(body, "_Test Other"), "_Test Secret")
+
+	def test_webhook_without_signature_is_rejected(self):
+		with (
+			patch(f"{MODULE}.get_payment_gateway_controller", return_value=self.controller),
+			patch(f"{MODULE}.get_cached_password", return_value="_Test Secret"),
+			patch("frappe.get_request_header", return_value=None),
+		):
+			self.assertRaises(frappe.PermissionError, razorpay_webhook)
+
+	def verify_order(self, params, mapped_request="_Test IR"):
+		integration = frappe._dict(name="_Test IR")
+		with (
+			patch(f"{MODULE}.get_integration_request_by_reference", return_value=mapped_request),
+			patch.object(
+				self.controller, "get_settings", return_value=frappe._dict(api_secret="_Test Secret")
+			),
+		):
+			return verify_order_signature(self.controller, integration, params)
+
+	def test_order_signature(self):
+		params = {
+			"razorpay_order_id": "order_1",
+			"razorpay_payment_id": "pay_1",
+			"razorpay_signature": sign("order_1|pay_1", "_Test Secret"),
+		}
+		self.assertTrue(self.verify_order(params))
+
+	def test_order_signature_of_another_payment(self):
+		params = {
+			"razorpay_order_id": "order_1",
+			"razorpay_payment_id": "pay_2",
+			"razorpay_signature": sign("order_1|pay_1", "_Test Secret"),
+		}
+		with self.assertRaises(frappe.PermissionError):
+			self.verify_order(params)
+
+	def test_order_of_another_request_is_not_trusted(self):
+		params = {
+			"razorpay_order_id": "order_1",
+			"razorpay_payment_id": "pay_1",
+			"razorpay_signature": sign("order_1|pay_1", "_Test Secret"),
+		}
+		self.assertFalse(self.verify_order(params, mapped_request="_Test Other IR"))
+
+	def test_order_signature_missing(self):
+		self.assertFalse(self.verify_order({"razorpay_payment_id": "pay_1"}))
+
+
+class TestRazorpayOrderReuse(unittest.TestCase):
+	def setUp(self):
+		self.controller = frappe.get_doc("Razorpay Settings")
+		self.controller.api_key = "_Test Key"
+		self.controller.api_secret = "_Test Secret"
+		self.receipt = frappe.generate_hash(length=10)
+		self.order_ids = (f"order_test_{i}" for i in itertools.count())
+		self.integration_requests = []
+
+	def tearDown(self):
+		for amount in (100, 200):
+			frappe.cache().delete_value(get_order_cache_key(self.order_args(amount)))
+		frappe.db.delete("Integration Request", {"name": ("in", self.integration_requests)})
+
+	def order_args(self, amount=100):
+		return {
+			"amount": amount,
+			"currency": "INR",
+			"receipt": self.receipt,
+			"payment_capture": 1,
+			"reference_doctype": "User",
+			"reference_docname": "Administrator",
+		}
+
+	def create_order(self, amount=100):
+		with (
+			patch(f"{MODULE}.get_cached_password", return_value="_Test Secret"),
+			patch(f"{MODULE}.make_post_request", side_effect=lambda *a, **kw: {"id": next(self.order_ids)}),
+		):
+			order = self.controller.create_order(**self.order_args(amount))
+
+		self.integration_requests.append(order["integration_request"])
+		return order
+
+	def test_same_reference_reuses_the_order(self):
+		first = self.create_order()
+		second = self.create_order()
+
+		self.assertEqual(second["id"], first["id"])
+		self.assertEqual(second["integration_request"], first["integration_request"])
+
+	def test_different_amount_creates_a_new_order(self):
+		first = self.create_order(100)
+		second = self.create_order(200)
+
+		self.assertNotEqual(second["id"], first["id"])
+		self.assertNotEqual(second["integration_request"], first["integration_request"])
+
+	def test_authorized_order_is_not_reused(self):
+		first = self.create_order()
+		frappe.db.set_value("Integration Request", first["integration_request"], "status", "Authorized")
+
+		second = self.create_order()
+
+		self.assertNotEqual(second["id"], first["id"])
+		self.assertNotEqual(second["integration_request"], first["integration_request"])
+
+
+class TestRazorpayCapture(unittest.TestCase):
+	def setUp(self):
+		self.integration_requests = [
+			frappe.get_doc(
+				{
+					"doctype": "Integration Request",
+					"integration_request_service": "Razorpay",
+					"status": "Authorized",
+					"data": json.dumps({"razorpay_payment_id": f"pay_test_{i}", "amount": 100}),
+				}
+			)
+			.insert(ignore_permissions=True)
+			.name
+			for i in range(5)
+		]
+		frappe.db.commit()
+
+	def tearDown(self):
+		frappe.db.delete("Integration Request", {"name": ("in", self.integration_requests)})
+		frappe.db.commit()
+
+	def capture(self):
+		visited = []
+
+		def get_page(cursor, page_size):
+			page = get_authorized_payments(cursor, page_size)
+			visited.extend(doc.name for doc in page if doc.name in self.integration_requests)
+			return page
+
+		with (
+			patch.dict(frappe.conf, {"razorpay_capture_page_size": 2}),
+			patch(f"{MODULE}.get_authorized_payments", side_effect=get_page),
+		):
+			capture_payment(is_sandbox=True, sanbox_response={"status": "captured"})
+
+		return visited
+
+	def get_statuses(self):
+		return frappe.get_all(
+			"Integration Request",
+			{"name": ("in", self.integration_requests)},
+			pluck="status",
+		)
+
+	def test_every_request_is_captured_once(self):
+		visited = self.capture()
+
+		self.assertCountEqual(visited, self.integration_requests)
+		self.assertEqual(set(self.get_statuses()), {"Completed"})
+
+		data = json.loads(frappe.db.get_value("Integration Request", visited[0], "data"))
+		self.assertEqual(data["razorpay_status"], "captured")
+
+	def test_nothing_is_captured_while_another_run_holds_the_lock(self):
+		cache = frappe.cache()
+		lock = cache.lock(cache.make_key("razorpay_capture_payment"), timeout=60)
+		self.assertTrue(lock.acquire(blocking=False))
+		try:
+			visited = self.capture()
+		finally:
+			lock.release()
+
+		self.assertEqual(visited, [])
+		self.assertEqual(set(self.get_statuses()), {"Authorized"})
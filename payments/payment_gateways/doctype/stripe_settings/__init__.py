@@ -0,0 +1,122 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+import json
+
+import frappe
+from frappe.utils import call_hook_method
+
+from payments.utils import (
+	get_cached_decrypted_password,
+	get_integration_request_by_reference,
+	insert_webhook_request,
+	integration_request_update,
+)
+
+# Integration Request status set by each event on the request that made the payment
+EVENT_STATUS = {
+	"payment_intent.succeeded": "Completed",
+	"charge.succeeded": "Completed",
+	"invoice.paid": "Completed",
+	"payment_intent.payment_failed": "Failed",
+	"charge.failed": "Failed",
+	"invoice.payment_failed": "Failed",
+	"charge.refunded": "Cancelled",
+}
+# events may arrive out of order, a failure never overrides a completed payment
+STATUS_RANK = {"Queued": 0, "Authorized": 0, "Failed": 0, "Completed": 1, "Cancelled": 2}
+
+
+@frappe.whitelist(allow_guest=True, methods=["POST"])
+def webhooks(account=None):
+	"""Store a verified Stripe event and process it in the background
+
+	`account` is the Stripe Settings the endpoint was registered for. Redelivered events
+	carry the same event id and are dropped here."""
+	import stripe
+
+	payload = frappe.request.get_data(as_text=True)
+	signature = frappe.get_request_header("Stripe-Signature")
+
+	event = None
+	for secret in get_webhook_secrets(account):
+		try:
+			event = stripe.Webhook.construct_event(payload, signature, secret)
+			break
+		except (ValueError, stripe.error.SignatureVerificationError):
+			continue
+
+	if not event:
+		raise frappe.AuthenticationError
+
+	doc = insert_webhook_request("Stripe", event.id, payload, f"Webhook: {event.type}")
+	if not doc:
+		return
+
+	frappe.enqueue(
+		"payments.payment_gateways.doctype.stripe_settings.process_webhook_event",
+		queue="short",
+		integration_request=doc.name,
+	)
+
+
+def get_webhook_secrets(account=None):
+	accounts = [account] if account else frappe.get_all("Stripe Settings", pluck="name")
+	secrets = [
+		get_cached_decrypted_password(
+			"Stripe Settings", name, "webhook_secret", raise_exception=False
+		)
+		for name in accounts
+	]
+
+	return [secret for secret in secrets if secret]
+
+
+def process_webhook_event(integration_request):
+	integration_request = frappe.get_doc("Integration Request", integration_request)
+	event = json.loads(integration_request.data)
+	obj = event["data"]["object"]
+
+	with integration_request_update(integration_request) as changes:
+		payment_request = get_payment_request(obj)
+		if payment_request:
+			changes.reference_doctype = "Integration Request"
+			changes.reference_docname = payment_request
+
+			status = EVENT_STATUS.get(event["type"])
+			if event["type"] == "charge.refunded" and not obj.get("refunded"):
+				# partial refund
+				status = None
+
+			if status:
+				set_payment_status(payment_request, status)
+
+		changes.status = "Completed"
+
+	if event["type"].startswith(("invoice.", "customer.subscription.")):
+		call_hook_method(
+			"handle_subscription_notification",
+			doctype="Integration Request",
+			docname=integration_request.name,
+		)
+
+
+def get_payment_request(obj):
+	"""Return the Integration Request that created the Stripe object, or the payment it
+	belongs to"""
+	for key in ("id", "payment_intent", "charge", "subscription"):
+		integration_request = get_integration_request_by_reference("Stripe", obj.get(key))
+		if integration_request:
+			return integration_request
+
+	return (obj.get("metadata") or {}).get("integration_request")
+
+
+def set_payment_status(integration_request, status):
+	current = frappe.db.get_value("Integration Request", integration_request, "status")
+	if current is None or STATUS_RANK.get(status, 0) < STATUS_RANK.get(current, 0):
+		return
+
+	frappe.db.set_value(
+		"Integration Request", integration_request, "status", status, update_modified=False
+	)
@@ -1,15 +1,24 @@
 # Copyright (c) 2017, Frappe Technologies and contributors
 # License: MIT. See LICENSE
 
+import hashlib
+import json
 from urllib.parse import urlencode
 
 import frappe
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_get_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, flt, get_url
 
-from payments.utils import create_payment_gateway
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_payment_gateway_name,
+	integration_request_update,
+	set_payment_gateway_reference,
+)
+from payments.utils.transport import make_get_request
 
 
 class StripeSettings(Document):
@@ -149,12 +158,10 @@ class StripeSettings(Document):
 	}
 
 	def on_update(self):
-		create_payment_gateway(
-			"Stripe-" + self.gateway_name,
-			settings="Stripe Settings",
-			controller=self.gateway_name,
-		)
-		call_hook_method("payment_gateway_enabled", gateway="Stripe-" + self.gateway_name)
+		gateway = get_payment_gateway_name(self.doctype, self.gateway_name)
+		create_payment_gateway(gateway, settings=self.doctype, controller=self.gateway_name)
+		call_hook_method("payment_gateway_enabled", gateway=gateway)
+		clear_payment_gateway_cache()
 		if not self.flags.ignore_mandatory:
 			self.validate_stripe_credentails()
 
@@ -191,13 +198,15 @@ class StripeSettings(Document):
 		return get_url(f"./stripe_checkout?{urlencode(kwargs)}")
 
 	def create_request(self, data):
-		import stripe
+		from payments.payment_gateways.stripe_integration import get_stripe_client
 
 		self.data = frappe._dict(data)
-		stripe.api_key = self.get_password(fieldname="secret_key", raise_exception=False)
-		stripe.default_http_client = stripe.http_client.RequestsClient()
+		self.client = get_stripe_client(self.name)
 
 		try:
+			if self.use_payment_intents:
+				return self.create_payment_intent_on_stripe()
+
 			self.integration_request = create_request_log(self.data, service_name="Stripe")
 			return self.create_charge_on_stripe()
 
@@ -214,10 +223,10 @@ class StripeSettings(Document):
 			}
 
 	def create_charge_on_stripe(self):
-		import stripe
-
 		try:
-			charge = stripe.Charge.create(
+			charge = self.client.call(
+				"Charge",
+				"create",
 				amount=cint(flt(self.data.amount) * 100),
 				currency=self.data.currency,
 				source=self.data.stripe_token_id,
@@ -225,6 +234,8 @@ class StripeSettings(Document):
 				receipt_email=self.data.payer_email,
 			)
 
+			set_payment_gateway_reference("Stripe", charge.id, self.integration_request.name)
+
 			if charge.captured == True:
 				self.integration_request.db_set("status", "Completed", update_modified=False)
 				self.flags.status_changed_to = "Completed"
@@ -237,6 +248,66 @@ class StripeSettings(Document):
 
 		return self.finalize_request()
 
+	def create_payment_intent_on_stripe(self):
+		"""Charge the card with a confirmed PaymentIntent
+
+		The Integration Request is named after the reference document and card token and its name
+		is sent as the idempotency key, so a resubmitted payment either returns the stored result
+		or gets Stripe's cached response for the first attempt, never a second charge."""
+		name = get_payment_intent_request_name(self.data)
+		if frappe.db.exists("Integration Request", name):
+			self.integration_request = frappe.get_doc("Integration Request", name)
+		else:
+			try:
+				self.integration_request = create_request_log(self.data, service_name="Stripe", name=name)
+			except frappe.DuplicateEntryError:
+				# a concurrent submit inserted it first, the insert only fails once that one has
+				# committed, a locking read sees its result
+				self.integration_request = frappe.get_doc("Integration Request", name, for_update=True)
+
+		if self.integration_request.status in ("Completed", "Failed"):
+			# already processed, reuse the result without calling Stripe or the reference again
+			self.flags.status_changed_to = self.integration_request.status
+			self.flags.reused_result = True
+			return self.finalize_request()
+
+		try:
+			with integration_request_update(self.integration_request) as changes:
+				intent = self.client.call(
+					"PaymentIntent",
+					"create",
+					amount=cint(flt(self.data.amount) * 100),
+					currency=self.data.currency,
+					payment_method_data={"type": "card", "card": {"token": self.data.stripe_token_id}},
+					confirm=True,
+					description=self.data.description,
+					receipt_email=self.data.payer_email,
+					metadata={"integration_request": name},
+					idempotency_key=name,
+				)
+				changes.output = json.dumps({"payment_intent": intent.id, "status": intent.status})
+				set_payment_gateway_reference("Stripe", intent.id, name)
+
+				if intent.status == "succeeded":
+					changes.status = "Completed"
+					self.flags.status_changed_to = "Completed"
+				else:
+					changes.status = "Failed"
+					frappe.log_error(
+						f"PaymentIntent {intent.id}: {intent.status}", "Stripe Payment not completed"
+					)
+
+		except self.client.stripe.error.CardError as e:
+			with integration_request_update(self.integration_request) as changes:
+				changes.status = "Failed"
+				changes.error = str(e)
+
+		except Exception:
+			# left Queued, a retry sends the same idempotency key
+			frappe.log_error(frappe.get_traceback())
+
+		return self.finalize_request()
+
 	def finalize_request(self):
 		redirect_to = self.data.get("redirect_to") or None
 		redirect_message = self.data.get("redirect_message") or None
@@ -246,9 +317,10 @@ class StripeSettings(Document):
 			if self.data.reference_doctype and self.data.reference_docname:
 				custom_redirect_to = None
 				try:
-					custom_redirect_to = frappe.get_doc(
-						self.data.reference_doctype, self.data.reference_docname
-					).run_method("on_payment_authorized", self.flags.status_changed_to)
+					if not self.flags.reused_result:
+						custom_redirect_to = frappe.get_doc(
+							self.data.reference_doctype, self.data.reference_docname
+						).run_method("on_payment_authorized", self.flags.status_changed_to)
 				except Exception:
 					frappe.log_error(frappe.get_traceback())
 
@@ -276,6 +348,13 @@ class StripeSettings(Document):
 		return {"redirect_to": redirect_url, "status": status}
 
 
+def get_payment_intent_request_name(data):
+	key = frappe.as_json(
+		[data.reference_doctype, data.reference_docname, data.stripe_token_id], indent=None
+	)
+	return "stripe-" + hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
 def get_gateway_controller(doctype, docname):
 	reference_doc = frappe.get_doc(doctype, docname)
 	gateway_controller = frappe.db.get_value(
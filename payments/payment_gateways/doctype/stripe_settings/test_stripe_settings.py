@@ -1,7 +1,43 @@
 # Copyright (c) 2018, Frappe Technologies and Contributors
 # License: MIT. See LICENSE
+import hashlib
+import hmac
+import json
+import time
 import unittest
+from unittest.mock import patch
+
+import frappe
+
+from payments.payment_gateways.doctype.stripe_settings import webhooks
+
+MODULE = "payments.payment_gateways.doctype.stripe_settings"
 
 
 class TestStripeSettings(unittest.TestCase):
-	pass
+	payload = json.dumps({"id": "evt_1", "object": "event", "type": "charge.succeeded"})
+
+	def receive(self, secret):
+		timestamp = int(time.time())
+		signature = hmac.new(
+			secret.encode(), f"{timestamp}.{self.payload}".encode(), hashlib.sha256
+		).hexdigest()
+		request = frappe._dict(get_data=lambda as_text=False: self.payload)
+
+		with (
+			patch("frappe.request", request, create=True),
+			patch("frappe.get_request_header", return_value=f"t={timestamp},v1={signature}"),
+			patch(f"{MODULE}.get_webhook_secrets", return_value=["_Test Other", "_Test Secret"]),
+			patch(f"{MODULE}.insert_webhook_request", return_value=None) as insert,
+		):
+			webhooks()
+
+		return insert
+
+	def test_webhook_signed_by_any_account_secret(self):
+		insert = self.receive("_Test Secret")
+		self.assertEqual(insert.call_args.args[1], "evt_1")
+
+	def test_webhook_with_wrong_signature_is_rejected(self):
+		with self.assertRaises(frappe.AuthenticationError):
+			self.receive("_Test Wrong Secret")
@@ -1,18 +1,79 @@
 # Copyright (c) 2018, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
-import stripe
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 
+from payments.utils import (
+	get_cached_decrypted_password,
+	get_payment_gateway_name,
+	get_payment_gateway_reference_name,
+	set_payment_gateway_reference,
+)
+from payments.utils.transport import get_session, get_timeout
+from payments.utils.utils import get_generation_cached
+
+# stripe http clients bound to the pooled api.stripe.com session, keyed by timeout
+_http_clients = {}
+# StripeClient per Stripe Settings name
+_stripe_clients = {}
+# seconds a cached plan price is served without reading the Subscription Plan
+PLAN_PRICE_CACHE_TTL = 60 * 60
+
+
+def get_http_client():
+	"""Return a stripe HTTP client that reuses the pooled session of this worker"""
+	import stripe
+
+	timeout = get_timeout()
+	if timeout not in _http_clients:
+		_http_clients[timeout] = stripe.http_client.RequestsClient(
+			timeout=timeout, session=get_session(stripe.api_base)
+		)
+
+	return _http_clients[timeout]
+
+
+def get_stripe_client(gateway_name):
+	"""Return the `StripeClient` for a Stripe Settings record, built once per worker and
+	rebuilt after any Stripe Settings or Payment Gateway is saved"""
+
+	def make_client():
+		api_key = get_cached_decrypted_password(
+			"Stripe Settings", gateway_name, "secret_key", raise_exception=False
+		)
+		return StripeClient(api_key)
+
+	return get_generation_cached(_stripe_clients, gateway_name, make_client)
+
+
+class StripeClient:
+	"""Stripe API calls made with the secret key of one Stripe Settings record
+
+	The key is passed with every call instead of being set on the `stripe` module, so workers
+	can serve several Stripe accounts at the same time."""
+
+	def __init__(self, api_key):
+		import stripe
+
+		self.stripe = stripe
+		self.api_key = api_key
+
+		# holds no credentials, only the pooled session, shared by every account
+		http_client = get_http_client()
+		if stripe.default_http_client is not http_client:
+			stripe.default_http_client = http_client
+
+	def call(self, resource, method, *args, **kwargs):
+		"""`client.call("Charge", "create", amount=100)` is `stripe.Charge.create(amount=100)`"""
+		return getattr(getattr(self.stripe, resource), method)(*args, api_key=self.api_key, **kwargs)
+
 
 def create_stripe_subscription(gateway_controller, data):
 	stripe_settings = frappe.get_doc("Stripe Settings", gateway_controller)
 	stripe_settings.data = frappe._dict(data)
-
-	stripe.api_key = stripe_settings.get_password(fieldname="secret_key", raise_exception=False)
-	stripe.default_http_client = stripe.http_client.RequestsClient()
+	stripe_settings.client = get_stripe_client(gateway_controller)
 
 	try:
 		stripe_settings.integration_request = create_request_log(stripe_settings.data, "Host", "Stripe")
@@ -35,19 +96,22 @@ def create_stripe_subscription(gateway_controller, data):
 
 
 def create_subscription_on_stripe(stripe_settings):
-	items = []
-	for payment_plan in stripe_settings.payment_plans:
-		plan = frappe.db.get_value("Subscription Plan", payment_plan.plan, "product_price_id")
-		items.append({"price": plan, "quantity": payment_plan.qty})
+	prices = get_plan_prices([payment_plan.plan for payment_plan in stripe_settings.payment_plans])
+	items = [
+		{"price": prices.get(payment_plan.plan), "quantity": payment_plan.qty}
+		for payment_plan in stripe_settings.payment_plans
+	]
 
 	try:
-		customer = stripe.Customer.create(
-			source=stripe_settings.data.stripe_token_id,
-			description=stripe_settings.data.payer_name,
-			email=stripe_settings.data.payer_email,
+		customer, source = get_or_create_customer(stripe_settings)
+
+		subscription = stripe_settings.client.call(
+			"Subscription", "create", customer=customer, items=items, default_source=source
 		)
 
-		subscription = stripe.Subscription.create(customer=customer, items=items)
+		set_payment_gateway_reference(
+			"Stripe", subscription.id, stripe_settings.integration_request.name
+		)
 
 		if subscription.status == "active":
 			stripe_settings.integration_request.db_set("status", "Completed", update_modified=False)
@@ -61,3 +125,99 @@ def create_subscription_on_stripe(stripe_settings):
 		stripe_settings.log_error("Unable to create Stripe subscription")
 
 	return stripe_settings.finalize_request()
+
+
+def get_plan_prices(plans):
+	"""Return `{plan: product_price_id}`, reading the plans missing from the cache in one query
+
+	Every plan is its own field of the cached hash, so a worker only ever writes back the
+	plans it read. The hash expires, which bounds how long a price read just before a plan
+	was saved can be served."""
+	cache = frappe.cache()
+	prices = {plan: cache.hget("stripe_plan_prices", plan) for plan in set(plans)}
+
+	missing = [plan for plan, price in prices.items() if price is None]
+	if missing:
+		for plan, price in frappe.get_all(
+			"Subscription Plan",
+			filters={"name": ("in", missing)},
+			fields=["name", "product_price_id"],
+			as_list=True,
+		):
+			prices[plan] = price
+			cache.hset("stripe_plan_prices", plan, price)
+
+		cache.expire(cache.make_key("stripe_plan_prices"), PLAN_PRICE_CACHE_TTL)
+
+	return prices
+
+
+def clear_plan_price_cache(doc=None, method=None):
+	frappe.cache().delete_value("stripe_plan_prices")
+
+
+def get_or_create_customer(stripe_settings):
+	"""Return the ids of the Stripe customer for the payer and of the new card
+
+	Customers are recorded in Payment Gateway Reference with the party of the reference
+	document, or the logged in user, so a returning payer of the same Stripe account reuses
+	their customer. The card is added to that customer without replacing its default source,
+	the caller charges it by passing it explicitly."""
+	data = stripe_settings.data
+	payment_gateway = get_payment_gateway_name(stripe_settings.doctype, stripe_settings.name)
+	payer = get_payer(data)
+
+	customer_id = payer and frappe.db.get_value(
+		"Payment Gateway Reference",
+		{"payment_gateway": payment_gateway, "payer": payer},
+		"external_id",
+	)
+
+	if customer_id:
+		try:
+			source = stripe_settings.client.call(
+				"Customer", "create_source", customer_id, source=data.stripe_token_id
+			)
+			return customer_id, source.id
+		except stripe_settings.client.stripe.error.InvalidRequestError as e:
+			if e.code != "resource_missing":
+				raise
+
+			# deleted on Stripe, forget it and create a new one
+			frappe.delete_doc(
+				"Payment Gateway Reference",
+				get_payment_gateway_reference_name(payment_gateway, customer_id),
+				ignore_permissions=True,
+			)
+
+	customer = stripe_settings.client.call(
+		"Customer",
+		"create",
+		source=data.stripe_token_id,
+		description=data.payer_name,
+		email=data.payer_email,
+	)
+
+	if payer:
+		set_payment_gateway_reference(
+			payment_gateway, customer.id, stripe_settings.integration_request.name, payer=payer
+		)
+
+	return customer.id, customer.default_source
+
+
+def get_payer(data):
+	"""Return the party of the reference document, or the logged in user, as `"{doctype}:{name}"`
+
+	The payer email is entered on the checkout page and is never used to find a customer."""
+	if data.reference_doctype and data.reference_docname:
+		meta = frappe.get_meta(data.reference_doctype)
+		if meta.has_field("party_type") and meta.has_field("party"):
+			party_type, party = frappe.db.get_value(
+				data.reference_doctype, data.reference_docname, ["party_type", "party"]
+			)
+			if party_type and party:
+				return f"{party_type}:{party}"
+
+	if frappe.session.user != "Guest":
+		return f"User:{frappe.session.user}"
@@ -3,6 +3,12 @@
 
 from frappe.model.document import Document
 
+from payments.utils import clear_payment_gateway_cache
+
 
 class PaymentGateway(Document):
-	pass
+	def on_update(self):
+		clear_payment_gateway_cache()
+
+	def on_trash(self):
+		clear_payment_gateway_cache()
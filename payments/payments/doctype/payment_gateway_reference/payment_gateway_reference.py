@@ -0,0 +1,11 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and contributors
+# License: MIT. See LICENSE
+
+from frappe.model.document import Document
+
+from payments.utils import get_payment_gateway_reference_name
+
+
+class PaymentGatewayReference(Document):
+	def autoname(self):
+		self.name = get_payment_gateway_reference_name(self.payment_gateway, self.external_id)
@@ -0,0 +1,44 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and Contributors
+# License: MIT. See LICENSE
+import unittest
+
+import frappe
+
+from payments.utils import (
+	get_integration_request_by_reference,
+	insert_webhook_request,
+	set_payment_gateway_reference,
+)
+
+
+class TestPaymentGatewayReference(unittest.TestCase):
+	def tearDown(self):
+		names = frappe.get_all(
+			"Payment Gateway Reference", {"payment_gateway": "_Test Gateway"}, pluck="integration_request"
+		)
+		frappe.db.delete("Payment Gateway Reference", {"payment_gateway": "_Test Gateway"})
+		frappe.db.delete("Integration Request", {"name": ("in", names)})
+		frappe.db.commit()
+
+	def test_reference_finds_the_request(self):
+		doc = insert_webhook_request("_Test Gateway", "_test_evt_1", "{}", "Webhook")
+
+		self.assertEqual(doc.status, "Queued")
+		self.assertEqual(get_integration_request_by_reference("_Test Gateway", "_test_evt_1"), doc.name)
+		self.assertIsNone(get_integration_request_by_reference("_Test Gateway", "_test_evt_2"))
+
+	def test_redelivered_webhook_is_dropped(self):
+		first = insert_webhook_request("_Test Gateway", "_test_evt_1", "{}", "Webhook")
+
+		self.assertIsNone(insert_webhook_request("_Test Gateway", "_test_evt_1", "{}", "Webhook"))
+		self.assertEqual(frappe.db.count("Integration Request", {"name": first.name}), 1)
+
+	def test_duplicate_reference(self):
+		doc = insert_webhook_request("_Test Gateway", "_test_evt_1", "{}", "Webhook")
+
+		# mapping an id again is a no-op unless duplicates are to be detected
+		set_payment_gateway_reference("_Test Gateway", "_test_evt_1", doc.name)
+		with self.assertRaises(frappe.DuplicateEntryError):
+			set_payment_gateway_reference(
+				"_Test Gateway", "_test_evt_1", doc.name, ignore_if_duplicate=False
+			)
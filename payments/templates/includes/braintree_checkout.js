@@ -6,50 +6,75 @@ $(document).ready(function() {
 	var doctype = "{{ reference_doctype }}"
 	var docname = "{{ reference_docname }}"
 
-	braintree.dropin.create({
-		authorization: "{{ client_token }}",
-		container: '#bt-dropin',
-		paypal: {
-			flow: 'vault'
-		}
-	}, function(createErr, instance) {
-		form.addEventListener('submit', function(event) {
-			event.preventDefault();
-			instance.requestPaymentMethod(function(err, payload) {
-				if (err) {
-					console.log('Error', err);
-					return;
-				}
-				frappe.call({
-					method: "payments.templates.pages.braintree_checkout.make_payment",
-					freeze: true,
-					headers: {
-						"X-Requested-With": "XMLHttpRequest"
-					},
-					args: {
-						"payload_nonce": payload.nonce,
-						"data": JSON.stringify(data),
-						"reference_doctype": doctype,
-						"reference_docname": docname
-					},
-					callback: function(r) {
-						if (r.message && r.message.status == "Completed") {
-							window.location.href = r.message.redirect_to
-						} else if (r.message && r.message.status == "Error") {
-							window.location.href = r.message.redirect_to
-						}
+	var create_dropin = function(client_token) {
+		braintree.dropin.create({
+			authorization: client_token,
+			container: '#bt-dropin',
+			paypal: {
+				flow: 'vault'
+			}
+		}, function(createErr, instance) {
+			if (createErr) {
+				window.location.href = "/payment-failed";
+				return;
+			}
+
+			form.addEventListener('submit', function(event) {
+				event.preventDefault();
+				instance.requestPaymentMethod(function(err, payload) {
+					if (err) {
+						console.log('Error', err);
+						return;
 					}
-				})
+					frappe.call({
+						method: "payments.templates.pages.braintree_checkout.make_payment",
+						freeze: true,
+						headers: {
+							"X-Requested-With": "XMLHttpRequest"
+						},
+						args: {
+							"payload_nonce": payload.nonce,
+							"data": JSON.stringify(data),
+							"reference_doctype": doctype,
+							"reference_docname": docname
+						},
+						callback: function(r) {
+							if (r.message && r.message.status == "Completed") {
+								window.location.href = r.message.redirect_to
+							} else if (r.message && r.message.status == "Error") {
+								window.location.href = r.message.redirect_to
+							}
+						}
+					})
+				});
 			});
-		});
 
-		instance.on('paymentMethodRequestable', function (event) {
-			button.removeAttribute('disabled');
-		});
+			instance.on('paymentMethodRequestable', function (event) {
+				button.removeAttribute('disabled');
+			});
 
-		instance.on('noPaymentMethodRequestable', function () {
-			button.setAttribute('disabled', true);
+			instance.on('noPaymentMethodRequestable', function () {
+				button.setAttribute('disabled', true);
+			});
 		});
+	}
+
+	// the page is rendered without waiting for Braintree, the token is fetched here
+	frappe.call({
+		method: "payments.templates.pages.braintree_checkout.get_client_token",
+		args: {
+			"reference_docname": docname
+		},
+		callback: function(r) {
+			if (r.message) {
+				create_dropin(r.message);
+			} else {
+				window.location.href = "/payment-failed";
+			}
+		},
+		error: function() {
+			window.location.href = "/payment-failed";
+		}
 	});
 
 })
@@ -8,7 +8,7 @@ from frappe import _
 from frappe.utils import flt
 
 from payments.payment_gateways.doctype.braintree_settings.braintree_settings import (
-	get_client_token,
+	get_gateway_client_token,
 	get_gateway_controller,
 )
 
@@ -35,8 +35,7 @@ def get_context(context):
 		for key in expected_keys:
 			context[key] = frappe.form_dict[key]
 
-		context.client_token = get_client_token(context.reference_docname)
-
+		# the client token is fetched by the page, see get_client_token
 		context["amount"] = flt(context["amount"])
 
 		gateway_controller = get_gateway_controller(context.reference_docname)
@@ -53,6 +52,11 @@ def get_context(context):
 		raise frappe.Redirect
 
 
+@frappe.whitelist(allow_guest=True)
+def get_client_token(reference_docname):
+	return get_gateway_client_token(get_gateway_controller(reference_docname))
+
+
 @frappe.whitelist(allow_guest=True)
 def make_payment(payload_nonce, data, reference_doctype, reference_docname):
 	data = json.loads(data)
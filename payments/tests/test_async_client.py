@@ -0,0 +1,91 @@
+# Copyright (c) 2024, Frappe Technologies Pvt. Ltd. and Contributors
+# License: MIT. See LICENSE
+
+import asyncio
+import threading
+import time
+import unittest
+
+from payments.utils.async_client import RateLimiter, fan_out
+
+
+class TestFanOut(unittest.TestCase):
+	def test_results_are_in_input_order(self):
+		def slow_square(n):
+			# later items finish first
+			time.sleep((5 - n) * 0.01)
+			return n * n
+
+		results = fan_out(slow_square, range(5), concurrency=5)
+
+		self.assertEqual([r.item for r in results], [0, 1, 2, 3, 4])
+		self.assertEqual([r.result for r in results], [0, 1, 4, 9, 16])
+
+	def test_errors_are_captured_per_item(self):
+		def invert(n):
+			return 1 / n
+
+		results = fan_out(invert, [2, 0, 4])
+
+		self.assertEqual(results[0].result, 0.5)
+		self.assertIsInstance(results[1].error, ZeroDivisionError)
+		self.assertIsNone(results[1].result)
+		self.assertIn("ZeroDivisionError", results[1].traceback)
+		self.assertEqual(results[2].result, 0.25)
+		self.assertIsNone(results[2].error)
+
+	def test_concurrency_is_bounded(self):
+		lock = threading.Lock()
+		running = []
+		peak = []
+
+		def track(n):
+			with lock:
+				running.append(n)
+				peak.append(len(running))
+			time.sleep(0.02)
+			with lock:
+				running.remove(n)
+
+		fan_out(track, range(10), concurrency=3)
+
+		self.assertLessEqual(max(peak), 3)
+
+	def test_no_items(self):
+		self.assertEqual(fan_out(lambda n: n, []), [])
+
+
+class TestRateLimiter(unittest.TestCase):
+	def test_calls_are_spaced_out(self):
+		async def wait_all(limiter, n):
+			loop = asyncio.get_running_loop()
+			times = []
+
+			async def wait():
+				await limiter.wait()
+				times.append(loop.time())
+
+			await asyncio.gather(*(wait() for _ in range(n)))
+			return sorted(times)
+
+		times = asyncio.run(wait_all(RateLimiter(20), 5))
+
+		gaps = [b - a for a, b in zip(times, times[1:])]
+		# 20 per second, one call every 50ms
+		self.assertTrue(all(gap >= 0.04 for gap in gaps), gaps)
+
+	def test_no_rate_does_not_wait(self):
+		start = time.monotonic()
+		asyncio.run(asyncio.wait_for(wait_many(RateLimiter(None), 100), timeout=1))
+		self.assertLess(time.monotonic() - start, 0.5)
+
+	def test_rate_limited_fan_out(self):
+		start = time.monotonic()
+		results = fan_out(lambda n: n, range(5), rate_limit=20)
+
+		self.assertEqual([r.result for r in results], [0, 1, 2, 3, 4])
+		self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+
+async def wait_many(limiter, n):
+	await asyncio.gather(*(limiter.wait() for _ in range(n)))
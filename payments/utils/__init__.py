@@ -1,8 +1,18 @@
 from payments.utils.utils import (
 	before_install,
+	clear_payment_gateway_cache,
 	create_payment_gateway,
 	delete_custom_fields,
+	get_cached_decrypted_password,
+	get_cached_password,
+	get_integration_request_by_reference,
 	get_payment_gateway_controller,
+	get_payment_gateway_name,
+	get_payment_gateway_reference_name,
+	get_payment_gateway_registry,
+	insert_webhook_request,
+	integration_request_update,
 	make_custom_fields,
+	set_payment_gateway_reference,
 	erpnext_app_import_guard,
 )
@@ -0,0 +1,121 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Concurrent gateway calls for batch jobs.
+
+`fan_out` runs a function over many items on an asyncio event loop, with at most
+`concurrency` calls in flight, and returns one result per item in input order:
+
+	results = fan_out(capture, payments, concurrency=8)
+	for r in results:
+		if r.error:
+			frappe.log_error("Capture failed", r.traceback)
+
+`rate_limit` additionally spaces the calls out to at most that many per second, for
+gateways that throttle bulk operations.
+
+Each call runs in a worker thread that shares the pooled sessions of
+`payments.utils.transport`. The function should only talk to the gateway: the database
+connection is not thread safe, so reads belong before the fan out and writes after it.
+
+Site config:
+
+	"payments_batch_concurrency": 8
+"""
+
+import asyncio
+import contextvars
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import frappe
+
+from payments.utils import transport
+
+DEFAULT_CONCURRENCY = 8
+
+
+def get_concurrency(concurrency=None):
+	return concurrency or frappe.conf.get("payments_batch_concurrency") or DEFAULT_CONCURRENCY
+
+
+def fan_out(fn, items, concurrency=None, rate_limit=None):
+	"""Call `fn(item)` for every item concurrently, at most `rate_limit` calls per second
+
+	Returns a list of `frappe._dict(item, result, error, traceback)`, one per item."""
+	items = list(items)
+	if not items:
+		return []
+
+	return asyncio.run(_fan_out(fn, items, get_concurrency(concurrency), rate_limit))
+
+
+async def _fan_out(fn, items, concurrency, rate_limit=None):
+	with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+		client = AsyncClient(executor)
+		semaphore = asyncio.Semaphore(concurrency)
+		limiter = RateLimiter(rate_limit)
+
+		async def run(item):
+			async with semaphore:
+				await limiter.wait()
+				try:
+					result = await client.run(fn, item)
+				except Exception as e:
+					return frappe._dict(
+						item=item, result=None, error=e, traceback="".join(traceback.format_exception(e))
+					)
+
+				return frappe._dict(item=item, result=result, error=None, traceback=None)
+
+		return await asyncio.gather(*(run(item) for item in items))
+
+
+class RateLimiter:
+	"""Spaces out callers of `wait` to at most `rate` per second, no limit if `rate` is falsy"""
+
+	def __init__(self, rate=None):
+		self.interval = 1 / rate if rate else 0
+		self.next_at = 0
+		self.lock = asyncio.Lock()
+
+	async def wait(self):
+		if not self.interval:
+			return
+
+		async with self.lock:
+			now = asyncio.get_running_loop().time()
+			delay = max(0, self.next_at - now)
+			self.next_at = max(now, self.next_at) + self.interval
+
+		if delay:
+			await asyncio.sleep(delay)
+
+
+class AsyncClient:
+	"""Awaitable wrappers around the pooled transport, for use inside an event loop"""
+
+	def __init__(self, executor=None):
+		self.executor = executor
+
+	async def run(self, fn, *args, **kwargs):
+		# copy the context so that frappe.local (site config) is available in the thread
+		context = contextvars.copy_context()
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(
+			self.executor, partial(context.run, fn, *args, **kwargs)
+		)
+
+	async def request(self, method, url, **kwargs):
+		"""Send a request through the pooled session, returns the `requests.Response`"""
+		return await self.run(transport.request, method, url, **kwargs)
+
+	async def get(self, url, **kwargs):
+		"""GET `url` and return the parsed JSON (or NVP) response, raises on HTTP errors"""
+		return await self.run(transport.fetch, "GET", url, **kwargs)
+
+	async def post(self, url, **kwargs):
+		"""POST to `url` and return the parsed JSON (or NVP) response, raises on HTTP errors"""
+		return await self.run(transport.fetch, "POST", url, **kwargs)
@@ -0,0 +1,96 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Bulk gateway operations recorded on Integration Requests.
+
+`run_bulk_requests` calls the gateway once per id through `fan_out`, in batches, and
+records every response or error on an Integration Request:
+
+	run_bulk_requests(
+		"Razorpay",
+		"Cancel Subscription",
+		subscription_ids,
+		cancel,
+		rate_limit=10,
+		title=_("Cancelling Razorpay Subscriptions"),
+	)
+
+Ids that already have an Integration Request, as returned by `get_integration_request`,
+have the outcome recorded on it, every other id gets a new request.
+"""
+
+import json
+
+import frappe
+from frappe import _
+
+from payments.utils.async_client import fan_out
+from payments.utils.utils import integration_request_update
+
+BATCH_SIZE = 100
+
+
+def run_bulk_requests(
+	service,
+	description,
+	ids,
+	call,
+	rate_limit=None,
+	title=None,
+	get_integration_request=None,
+	status="Completed",
+):
+	"""Call `call(id)` for every id, at most `rate_limit` calls per second
+
+	Existing requests are moved to `status` on success, if given, and keep their status on
+	failure, new requests end up Completed or Failed. The database is committed and the progress
+	published after every batch.
+
+	Returns the number of successful calls."""
+	ids = list(dict.fromkeys(ids))
+	succeeded = 0
+
+	for start in range(0, len(ids), BATCH_SIZE):
+		batch = ids[start : start + BATCH_SIZE]
+		integration_requests = {}
+		created = set()
+		for id in batch:
+			name = get_integration_request(id) if get_integration_request else None
+			if name:
+				integration_requests[id] = frappe.get_doc("Integration Request", name)
+				continue
+
+			integration_requests[id] = frappe.get_doc(
+				{
+					"doctype": "Integration Request",
+					"integration_request_service": service,
+					"request_description": description,
+					"data": json.dumps({"id": id}),
+					"status": "Queued",
+				}
+			).insert(ignore_permissions=True)
+			created.add(id)
+
+		for result in fan_out(call, batch, rate_limit=rate_limit):
+			with integration_request_update(integration_requests[result.item]) as changes:
+				if result.error:
+					changes.error = result.traceback
+					if result.item in created:
+						changes.status = "Failed"
+				else:
+					changes.output = json.dumps(result.result)
+					if result.item in created or status:
+						changes.status = "Completed" if result.item in created else status
+					succeeded += 1
+
+		frappe.db.commit()
+
+		done = start + len(batch)
+		frappe.publish_progress(
+			done * 100 / len(ids),
+			title=title or _(description),
+			description=_("{0} of {1} processed, {2} succeeded").format(done, len(ids), succeeded),
+		)
+
+	return succeeded
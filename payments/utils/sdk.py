@@ -0,0 +1,81 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+Gateway SDKs are imported inside the functions that use them, so workers only pay for the
+SDKs of the gateways a site actually uses. The modules of each gateway are declared under
+`sdk` in the `payment_gateways` hook.
+
+Long-lived workers can import the SDKs of all enabled gateways up front by setting
+`"payments_preload_sdks": 1` in site config.
+
+To see what each SDK costs at startup:
+
+	bench --site {site} execute payments.utils.sdk.benchmark_sdk_imports
+"""
+
+import importlib
+import subprocess
+import sys
+
+import click
+import frappe
+
+from payments.utils import get_payment_gateway_registry
+
+_preloaded_sites = set()
+
+
+def get_enabled_gateway_sdks():
+	"""Return the SDK modules of gateways that have a Payment Gateway record on this site"""
+	registry = get_payment_gateway_registry()
+	enabled_settings = {
+		registry[name].settings
+		for name in frappe.get_all("Payment Gateway", pluck="name")
+		if name in registry
+	}
+
+	modules = []
+	for d in frappe.get_hooks("payment_gateways"):
+		if d["settings"] in enabled_settings:
+			modules.extend(m for m in d.get("sdk", []) if m not in modules)
+
+	return modules
+
+
+def preload_gateway_sdks():
+	"""Import the SDKs of enabled gateways, once per worker and site"""
+	if not frappe.conf.get("payments_preload_sdks") or frappe.local.site in _preloaded_sites:
+		return
+
+	_preloaded_sites.add(frappe.local.site)
+	for module in get_enabled_gateway_sdks():
+		try:
+			importlib.import_module(module)
+		except ImportError:
+			frappe.log_error(title=f"Payments: could not preload {module}")
+
+
+def benchmark_sdk_imports():
+	"""Print the cold import time of every declared gateway SDK"""
+	for d in frappe.get_hooks("payment_gateways"):
+		gateway = d.get("gateway") or d["prefix"].rstrip("-")
+		for module in d.get("sdk", []):
+			seconds = get_import_time(module)
+			if seconds is None:
+				click.secho(f"{gateway:<12} {module:<16} not installed", fg="yellow")
+			else:
+				click.echo(f"{gateway:<12} {module:<16} {seconds * 1000:8.1f} ms")
+
+
+def get_import_time(module):
+	"""Import `module` in a fresh interpreter and return the time it took, in seconds"""
+	code = (
+		"import time; start = time.perf_counter(); "
+		f"import {module}; print(time.perf_counter() - start)"
+	)
+	result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+	if result.returncode:
+		return None
+
+	return float(result.stdout.strip())
@@ -0,0 +1,144 @@
+# Copyright (c) 2024, Frappe Technologies and contributors
+# License: MIT. See LICENSE
+
+"""
+HTTP transport shared by the payment gateway integrations.
+
+Every worker keeps one `requests.Session` per gateway host, so consecutive calls reuse a
+keep-alive connection instead of paying for a new TCP and TLS handshake each time.
+All requests get a connect and read timeout.
+
+Site config:
+
+	"payments_http_connect_timeout": 5,
+	"payments_http_read_timeout": 30,
+	"payments_http_pool_size": 10,
+	"payments_prewarm_hosts": ["https://api.razorpay.com", "https://api.stripe.com"]
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import parse_qs, urlsplit
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_POOL_SIZE = 10
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_prewarmed_sites = set()
+
+
+def get_session(url):
+	"""Return the pooled session for the host of `url`"""
+	parts = urlsplit(url)
+	host = f"{parts.scheme}://{parts.netloc}"
+
+	session = _sessions.get(host)
+	if session is None:
+		with _sessions_lock:
+			session = _sessions.get(host)
+			if session is None:
+				session = _sessions[host] = make_session()
+
+	return session
+
+
+def make_session():
+	pool_size = frappe.conf.get("payments_http_pool_size") or DEFAULT_POOL_SIZE
+
+	# only connection errors and gateway errors on idempotent methods are retried,
+	# a payment POST is never sent twice
+	adapter = HTTPAdapter(
+		pool_connections=1,
+		pool_maxsize=pool_size,
+		max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+	)
+
+	session = requests.Session()
+	# the session is shared by every site and account of the worker, cookies set by one
+	# response must not be sent with another tenant's calls
+	session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	return session
+
+
+def get_timeout():
+	"""Return the (connect, read) timeout configured for this site"""
+	return (
+		frappe.conf.get("payments_http_connect_timeout") or DEFAULT_CONNECT_TIMEOUT,
+		frappe.conf.get("payments_http_read_timeout") or DEFAULT_READ_TIMEOUT,
+	)
+
+
+def request(method, url, **kwargs):
+	"""Send a request through the pooled session, returns the `requests.Response`"""
+	kwargs.setdefault("timeout", get_timeout())
+	return get_session(url).request(method, url, **kwargs)
+
+
+def fetch(method, url, **kwargs):
+	"""Send a request and return the parsed response, raises on HTTP errors
+
+	Unlike `make_request` this neither logs errors nor sets `frappe.flags`, so it is safe to
+	call from the worker threads of `payments.utils.async_client`."""
+	response = request(method, url, **kwargs)
+	response.raise_for_status()
+	return parse_response(response)
+
+
+def make_request(method, url, auth=None, headers=None, data=None, json=None, params=None):
+	"""Drop-in for `frappe.integrations.utils.make_request` that uses the pooled session"""
+	try:
+		response = request(
+			method, url, auth=auth, headers=headers, data=data, json=json, params=params
+		)
+		frappe.flags.integration_request = response
+		response.raise_for_status()
+
+		return parse_response(response)
+	except Exception:
+		frappe.log_error()
+		raise
+
+
+def parse_response(response):
+	if response.headers.get("content-type") == "text/plain; charset=utf-8":
+		return parse_qs(response.text)
+
+	return response.json()
+
+
+def make_get_request(url, **kwargs):
+	return make_request("GET", url, **kwargs)
+
+
+def make_post_request(url, **kwargs):
+	return make_request("POST", url, **kwargs)
+
+
+def prewarm_connections():
+	"""Open connections to `payments_prewarm_hosts` in the background, once per worker and site"""
+	hosts = frappe.conf.get("payments_prewarm_hosts")
+	if not hosts or frappe.local.site in _prewarmed_sites:
+		return
+
+	_prewarmed_sites.add(frappe.local.site)
+	for host in hosts:
+		get_session(host)
+
+	threading.Thread(target=_prewarm, args=(hosts, get_timeout()), daemon=True).start()
+
+
+def _prewarm(hosts, timeout):
+	for host in hosts:
+		try:
+			get_session(host).head(host, timeout=timeout)
+		except requests.RequestException:
+			pass
@@ -1,42 +1,166 @@
+import time
+
 import click
 import frappe
 from frappe import _
 from contextlib import contextmanager
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+from frappe.utils.password import get_decrypted_password
+
+DEFAULT_SECRET_CACHE_TTL = 60
+
+# process-wide state, see get_generation_cached, keyed by payment gateway (snapshots)
+# or by (doctype, name, fieldname) (secrets)
+_payment_gateway_registry = {}
+_payment_gateway_controllers = {}
+_secrets = {}
 
 
 def get_payment_gateway_controller(payment_gateway):
-	"""Return payment gateway controller"""
-	gateway = frappe.get_doc("Payment Gateway", payment_gateway)
-	if gateway.gateway_controller is None:
+	"""Return payment gateway controller
+
+	Settings are read from the database once per worker and served from an in-memory snapshot
+	after that. Every call returns a fresh controller built from the snapshot, so the caller can
+	set attributes on it without affecting other requests.
+	"""
+	gateway = get_payment_gateway_registry().get(payment_gateway)
+	if not gateway:
+		frappe.throw(_("{0} Settings not found").format(payment_gateway))
+
+	def get_settings():
 		try:
-			return frappe.get_doc(f"{payment_gateway} Settings")
-		except Exception:
+			return frappe.get_doc(gateway.settings, gateway.docname).as_dict()
+		except frappe.DoesNotExistError:
 			frappe.throw(_("{0} Settings not found").format(payment_gateway))
-	else:
+
+	settings = get_generation_cached(_payment_gateway_controllers, payment_gateway, get_settings)
+	return gateway.controller(dict(settings))
+
+
+def get_payment_gateway_registry():
+	"""Return a map of Payment Gateway name to its settings doctype, settings document name
+	and controller class, built once per worker from the `payment_gateways` hooks"""
+	return get_generation_cached(_payment_gateway_registry, None, build_payment_gateway_registry)
+
+
+def build_payment_gateway_registry():
+	from frappe.model.base_document import get_controller
+
+	declared = frappe.get_hooks("payment_gateways")
+	registry = {}
+
+	def register(gateway, settings, docname):
 		try:
-			return frappe.get_doc(gateway.gateway_settings, gateway.gateway_controller)
+			controller = get_controller(settings)
 		except Exception:
-			frappe.throw(_("{0} Settings not found").format(payment_gateway))
+			# e.g. a Payment Gateway left behind by an uninstalled app, it must not take the
+			# other gateways down with it
+			frappe.log_error(title=f"Could not load the controller of payment gateway {gateway}")
+			return
+
+		registry[gateway] = frappe._dict(settings=settings, docname=docname, controller=controller)
+
+	for d in declared:
+		if d.get("gateway"):
+			register(d["gateway"], d["settings"], d["settings"])
+
+	for d in frappe.get_all(
+		"Payment Gateway", fields=["name", "gateway_settings", "gateway_controller"]
+	):
+		if d.gateway_settings and d.gateway_controller:
+			register(d.name, d.gateway_settings, d.gateway_controller)
+		elif d.name not in registry and frappe.db.exists("DocType", f"{d.name} Settings"):
+			# gateways created by other apps without a declaration
+			register(d.name, f"{d.name} Settings", f"{d.name} Settings")
+
+	return registry
+
+
+def get_payment_gateway_name(settings, docname=None):
+	"""Return the Payment Gateway name for a settings document, as declared in `payment_gateways`"""
+	for d in frappe.get_hooks("payment_gateways"):
+		if d["settings"] == settings:
+			return d["prefix"] + docname if d.get("prefix") else d["gateway"]
+
+
+def get_cached_password(doc, fieldname, raise_exception=True):
+	"""Return `doc.get_password(fieldname)`, decrypted at most once per secret cache TTL"""
+	value = doc.get(fieldname)
+	if value and not doc.is_dummy_password(value):
+		# not saved yet, nothing to decrypt
+		return value
+
+	return get_cached_decrypted_password(doc.doctype, doc.name, fieldname, raise_exception)
+
+
+def get_cached_decrypted_password(doctype, name, fieldname, raise_exception=True):
+	"""Return a decrypted password, kept in memory for `payments_secret_cache_ttl` seconds
+
+	Entries are dropped as soon as a settings document or Payment Gateway is saved."""
+	return get_generation_cached(
+		_secrets,
+		(doctype, name, fieldname),
+		lambda: get_decrypted_password(doctype, name, fieldname, raise_exception=raise_exception),
+		ttl=frappe.conf.get("payments_secret_cache_ttl") or DEFAULT_SECRET_CACHE_TTL,
+	)
+
+
+def get_generation_cached(store, key, build, ttl=None):
+	"""Return `build()`, kept in `store` per worker for this site and `key`
+
+	The value is built again once any settings document or Payment Gateway has been saved, see
+	`clear_payment_gateway_cache`, and after `ttl` seconds if given."""
+	key = (frappe.local.site, key)
+	generation = get_payment_gateway_cache_generation()
+	now = time.monotonic()
+
+	cached = store.get(key)
+	if not cached or cached[0] != generation or (cached[1] and cached[1] <= now):
+		cached = store[key] = (generation, now + ttl if ttl else None, build())
+
+	return cached[2]
+
+
+def get_payment_gateway_cache_generation():
+	generation = frappe.cache().get_value("payment_gateway_cache_generation")
+	if not generation:
+		generation = bump_payment_gateway_cache_generation()
+
+	return generation
+
+
+def clear_payment_gateway_cache():
+	"""Invalidate the payment gateway registry, snapshots and secrets held by every worker of this site
+
+	The generation only changes once the current transaction is committed. Bumping it earlier
+	would let another worker cache the old settings under the new generation."""
+	frappe.db.after_commit.add(bump_payment_gateway_cache_generation)
+
+
+def bump_payment_gateway_cache_generation():
+	generation = frappe.generate_hash(length=10)
+	frappe.cache().set_value("payment_gateway_cache_generation", generation)
+	return generation
 
 
 @frappe.whitelist(allow_guest=True, xss_safe=True)
 def get_checkout_url(**kwargs):
-	try:
-		if kwargs.get("payment_gateway"):
-			doc = frappe.get_doc("{} Settings".format(kwargs.get("payment_gateway")))
-			return doc.get_payment_url(**kwargs)
-		else:
-			raise Exception
-	except Exception:
-		frappe.respond_as_web_page(
-			_("Something went wrong"),
-			_(
-				"Looks like something is wrong with this site's payment gateway configuration. No payment has been made."
-			),
-			indicator_color="red",
-			http_status_code=frappe.ValidationError.http_status_code,
-		)
+	payment_gateway = kwargs.get("payment_gateway")
+
+	if payment_gateway in get_payment_gateway_registry():
+		try:
+			return get_payment_gateway_controller(payment_gateway).get_payment_url(**kwargs)
+		except Exception:
+			frappe.log_error(title=_("Checkout URL for {0} failed").format(payment_gateway))
+
+	frappe.respond_as_web_page(
+		_("Something went wrong"),
+		_(
+			"Looks like something is wrong with this site's payment gateway configuration. No payment has been made."
+		),
+		indicator_color="red",
+		http_status_code=frappe.ValidationError.http_status_code,
+	)
 
 
 def create_payment_gateway(gateway, settings=None, controller=None):
@@ -191,6 +315,93 @@ def before_install():
 		return False
 
 
+@contextmanager
+def integration_request_update(integration_request):
+	"""Collect the field changes made to an Integration Request during a gateway call and write
+	them with a single UPDATE when the block exits, even if it raises.
+
+	with integration_request_update(self.integration_request) as changes:
+	        changes.status = "Completed"
+	        changes.output = result.transaction.status
+	"""
+	changes = frappe._dict()
+	try:
+		yield changes
+	finally:
+		if changes:
+			integration_request.db_set(changes, update_modified=False)
+
+
+def get_payment_gateway_reference_name(payment_gateway, external_id):
+	return f"{payment_gateway}:{external_id}"
+
+
+def get_integration_request_by_reference(payment_gateway, external_id):
+	"""Return the name of the Integration Request mapped to a gateway side id, if any"""
+	if not external_id:
+		return
+
+	return frappe.db.get_value(
+		"Payment Gateway Reference",
+		get_payment_gateway_reference_name(payment_gateway, external_id),
+		"integration_request",
+	)
+
+
+def set_payment_gateway_reference(
+	payment_gateway, external_id, integration_request, ignore_if_duplicate=True, payer=None
+):
+	"""Map a gateway side id (payment, order, event...) to an Integration Request, so that
+	webhooks can find the request by primary key
+
+	With `ignore_if_duplicate=False` an id that is already mapped raises
+	`frappe.DuplicateEntryError`, which is how redelivered events are detected."""
+	if not external_id:
+		return
+
+	if ignore_if_duplicate and get_integration_request_by_reference(payment_gateway, external_id):
+		return
+
+	frappe.get_doc(
+		{
+			"doctype": "Payment Gateway Reference",
+			"payment_gateway": payment_gateway,
+			"external_id": external_id,
+			"integration_request": integration_request,
+			"payer": payer,
+		}
+	).insert(ignore_permissions=True, ignore_if_duplicate=ignore_if_duplicate)
+
+
+def insert_webhook_request(payment_gateway, event_id, data, request_description):
+	"""Store a webhook as a Queued Integration Request and commit it, before it is processed
+
+	Gateways redeliver a webhook with the same `event_id` until it is acknowledged. Returns
+	None for a redelivery, including one that races the first delivery."""
+	if get_integration_request_by_reference(payment_gateway, event_id):
+		return
+
+	doc = frappe.get_doc(
+		{
+			"doctype": "Integration Request",
+			"integration_request_service": payment_gateway,
+			"request_description": request_description,
+			"is_remote_request": 1,
+			"data": data,
+			"status": "Queued",
+		}
+	).insert(ignore_permissions=True)
+
+	try:
+		set_payment_gateway_reference(payment_gateway, event_id, doc.name, ignore_if_duplicate=False)
+	except frappe.DuplicateEntryError:
+		frappe.db.rollback()
+		return
+
+	frappe.db.commit()
+	return doc
+
+
 @contextmanager
 def erpnext_app_import_guard():
 	marketplace_link = '<a href="https://frappecloud.com/marketplace/apps/erpnext">Marketplace</a>'